@@ -0,0 +1,258 @@
+# Batch mode for a whole library of scores.
+# The inputs can be score files, folders (searched recursively) or glob
+# patterns. Scores are converted by a pool of workers, and the manifest
+# records the status of every score with the conversion arguments it was
+# converted with. A run that was interrupted can be started again: the
+# scores that are already done with the same arguments (and did not change
+# since) are skipped. The unfinished ones resume through the render cache,
+# which holds their stems. The stages recorded in the manifest are
+# informational only, they are not used to resume a score.
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import shlex
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from converter import generate_leading_audios
+from render_cache import DEFAULT_CACHE_DIR
+
+SCORE_EXTENSIONS = (".mscz", ".mscx")
+# conversion arguments that only change how the work is scheduled, not the
+# outputs; they are left out of the arguments hash of the manifest
+SCHEDULING_ARGUMENTS = ("max_workers", "job_timeout", "streaming_split", "use_cache", "cache_dir")
+
+
+def find_scores(inputs):
+    # the generated `parts` folders are skipped, and so is the mscx produced
+    # from an mscz with the same name
+    found = []
+    for input_path in inputs:
+        if os.path.isdir(input_path):
+            for root, dirs, files in os.walk(input_path):
+                dirs[:] = sorted(d for d in dirs if d != "parts")
+                found.extend(os.path.join(root, f) for f in sorted(files))
+        elif os.path.exists(input_path):
+            found.append(input_path)
+        else:
+            found.extend(sorted(glob.glob(input_path, recursive = True)))
+
+    scores = []
+    seen = set()
+    for score_path in found:
+        score_path = os.path.abspath(score_path)
+        base_path, extension = os.path.splitext(score_path)
+        if extension not in SCORE_EXTENSIONS or score_path in seen:
+            continue
+        if extension == ".mscx" and os.path.exists(base_path + ".mscz"):
+            continue
+
+        seen.add(score_path)
+        scores.append(score_path)
+
+    return scores
+
+
+def _file_hash(filename):
+    with open(filename, "rb") as fin:
+        return hashlib.sha1(fin.read()).hexdigest()
+
+
+def _args_hash(conversion_args):
+    output_args = {key: value for key, value in conversion_args.items() if key not in SCHEDULING_ARGUMENTS}
+    return hashlib.sha1(json.dumps(output_args, sort_keys = True, default = str).encode()).hexdigest()
+
+
+class BatchManifest:
+    # {"scores": {score path: {"sha1", "args", "status", "stages", "seconds", "error"}}}
+    # `args` is the hash of the conversion arguments
+    def __init__(self, manifest_filename):
+        self.manifest_filename = manifest_filename
+        self._lock = threading.Lock()
+        try:
+            with open(manifest_filename) as fin:
+                self._scores = json.load(fin)["scores"]
+        except (OSError, ValueError, KeyError):
+            self._scores = dict()
+
+    def _save(self):
+        temp_filename = self.manifest_filename + ".tmp"
+        with open(temp_filename, "w") as fout:
+            json.dump({"scores": self._scores}, fout, indent = 2)
+        os.replace(temp_filename, self.manifest_filename)
+
+    def _is_same(self, entry, score_hash, args_hash):
+        return entry is not None and entry["sha1"] == score_hash and entry.get("args") == args_hash
+
+    def is_done(self, score_path, score_hash, args_hash):
+        with self._lock:
+            entry = self._scores.get(score_path)
+            return self._is_same(entry, score_hash, args_hash) and entry["status"] == "done"
+
+    def start(self, score_path, score_hash, args_hash):
+        with self._lock:
+            entry = self._scores.get(score_path)
+            # the stages of an interrupted run are kept if neither the score
+            # nor the arguments changed
+            if not self._is_same(entry, score_hash, args_hash):
+                entry = {"sha1": score_hash, "args": args_hash, "stages": []}
+            entry["status"] = "running"
+            entry.pop("error", None)
+            self._scores[score_path] = entry
+            self._save()
+
+    def stage_done(self, score_path, stage_name):
+        with self._lock:
+            stages = self._scores[score_path]["stages"]
+            if stage_name not in stages:
+                stages.append(stage_name)
+            self._save()
+
+    def finish(self, score_path, seconds, error = None):
+        with self._lock:
+            entry = self._scores[score_path]
+            entry["status"] = "done" if error is None else "failed"
+            entry["seconds"] = seconds
+            if error is not None:
+                entry["error"] = str(error)
+            self._save()
+
+
+def _convert_score(score_path, manifest, stage_executor, conversion_args):
+    score_hash = _file_hash(score_path)
+    args_hash = _args_hash(conversion_args)
+    if manifest.is_done(score_path, score_hash, args_hash):
+        return None
+
+    manifest.start(score_path, score_hash, args_hash)
+    start_time = time.monotonic()
+    try:
+        generate_leading_audios(input_filename = score_path,
+                                verbose = False,
+                                on_stage_done = lambda stage_name: manifest.stage_done(score_path, stage_name),
+                                executor = stage_executor,
+                                **conversion_args)
+    except Exception as error:
+        manifest.finish(score_path, time.monotonic() - start_time, error)
+        raise
+
+    seconds = time.monotonic() - start_time
+    manifest.finish(score_path, seconds)
+
+    return seconds
+
+
+def run_batch(scores, manifest_filename, score_workers = 2, max_workers = None, **conversion_args):
+    # Converts the scores and returns a summary of the run. At most
+    # `score_workers` scores are converted at the same time, and their
+    # renders / mixes share one pool of `max_workers` stage workers.
+    manifest = BatchManifest(manifest_filename)
+    durations = dict()
+    failures = dict()
+    n_skipped = 0
+    start_time = time.monotonic()
+
+    stage_executor = ThreadPoolExecutor(max_workers = max_workers or os.cpu_count() or 1,
+                                        thread_name_prefix = "stage")
+    with stage_executor, ThreadPoolExecutor(max_workers = score_workers, thread_name_prefix = "score") as executor:
+        futures = {executor.submit(_convert_score, score_path, manifest, stage_executor, conversion_args): score_path
+                   for score_path in scores}
+
+        for future in as_completed(futures):
+            score_path = futures[future]
+            try:
+                seconds = future.result()
+            except Exception as error:
+                failures[score_path] = error
+                print(f"[{time.strftime('%H:%M:%S')}] FAILED {score_path}: {error}")
+                continue
+
+            if seconds is None:
+                n_skipped += 1
+                print(f"[{time.strftime('%H:%M:%S')}] Skip already converted {score_path}")
+            else:
+                durations[score_path] = seconds
+                print(f"[{time.strftime('%H:%M:%S')}] Converted {score_path} in {seconds:.1f}s")
+
+    return {
+        "elapsed": time.monotonic() - start_time,
+        "durations": durations,
+        "failures": failures,
+        "skipped": n_skipped
+    }
+
+
+def print_summary(summary, n_slowest = 5):
+    n_converted = len(summary["durations"])
+    elapsed = summary["elapsed"]
+    scores_per_hour = n_converted * 3600 / elapsed if elapsed > 0 else 0
+
+    print(f"converted: {n_converted}, skipped: {summary['skipped']}, failed: {len(summary['failures'])}")
+    print(f"elapsed: {elapsed:.1f}s, throughput: {scores_per_hour:.1f} scores/hour")
+
+    slowest = sorted(summary["durations"].items(), key = lambda x: x[1], reverse = True)[:n_slowest]
+    if len(slowest) > 0:
+        print("slowest scores:")
+        for score_path, seconds in slowest:
+            print(f"  {seconds:8.1f}s  {score_path}")
+
+    if len(summary["failures"]) > 0:
+        print("failures:")
+        for score_path, error in summary["failures"].items():
+            print(f"  {score_path}: {error}")
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Generate the leading audio files for many scores.")
+    parser.add_argument("inputs", nargs = "+", help = "score files, folders or glob patterns")
+    parser.add_argument("--instrument", nargs = "+", default = ["clarinet"],
+                        help = "lead instrument(s); every instrument gets its own mixes")
+    parser.add_argument("--max-weight", nargs = "+", type = int, default = [3],
+                        help = "weight(s) of the lead in the mix; every weight gets its own mixes")
+    parser.add_argument("--manifest", default = "batch_manifest.json", help = "file recording the progress of the batch")
+    parser.add_argument("--score-workers", type = int, default = 2, help = "number of scores converted at the same time")
+    parser.add_argument("--max-workers", type = int, default = None,
+                        help = "number of renders / mixes run at the same time, over all the scores")
+    parser.add_argument("--job-timeout", type = float, default = None, help = "timeout in seconds for every render / mix")
+    parser.add_argument("--mix-engine", choices = ["ffmpeg", "numpy"], default = "ffmpeg",
+                        help = "mix with ffmpeg amix graphs or in process with numpy")
+    # the commands are split like a shell would, so they can carry their own
+    # options, e.g. --renderer "python benchmarks/stand_in_renderer.py --latency 1"
+    parser.add_argument("--renderer", type = shlex.split, default = None, help = "MuseScore command")
+    parser.add_argument("--ffmpeg", type = shlex.split, default = ["ffmpeg"], help = "ffmpeg command")
+    parser.add_argument("--cache-dir", default = DEFAULT_CACHE_DIR, help = "folder of the render cache")
+    parser.add_argument("--no-cache", action = "store_true",
+                        help = "render every stem again; an interrupted run then starts its scores from scratch")
+    parser.add_argument("--streaming-split", action = "store_true",
+                        help = "split the scores without loading them as a whole (for very large scores)")
+    args = parser.parse_args(argv)
+
+    scores = find_scores(args.inputs)
+    if len(scores) == 0:
+        exit("no score found")
+
+    summary = run_batch(scores,
+                        manifest_filename = args.manifest,
+                        score_workers = args.score_workers,
+                        target_instrument = args.instrument[0] if len(args.instrument) == 1 else args.instrument,
+                        max_weight = args.max_weight[0] if len(args.max_weight) == 1 else args.max_weight,
+                        max_workers = args.max_workers,
+                        job_timeout = args.job_timeout,
+                        streaming_split = args.streaming_split,
+                        mix_engine = args.mix_engine,
+                        renderer = args.renderer,
+                        ffmpeg = args.ffmpeg,
+                        use_cache = not args.no_cache,
+                        cache_dir = args.cache_dir)
+    print_summary(summary)
+
+    return 1 if len(summary["failures"]) > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
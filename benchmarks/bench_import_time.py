@@ -0,0 +1,85 @@
+# Import-time budget of the modules that every conversion starts with.
+# Every module is imported in fresh interpreters (`python -X importtime`),
+# the cumulative import time of the module is the median over the runs.
+# The check fails (exit status 1) when a module takes longer than its budget
+# or when it pulls in one of the heavy modules that are only needed by some
+# code paths (numpy for the numpy mixing engine, xmltodict to build the
+# instrument index).
+#
+# usage: python benchmarks/bench_import_time.py --output bench_import_time.json
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+# module -> budget in seconds
+BUDGETS = {
+    "staff_splitter": 0.1,
+    "converter": 0.25,
+    "batch_converter": 0.25,
+    "converter_daemon": 0.4
+}
+HEAVY_MODULES = ["numpy", "sympy", "xmltodict", "lxml.objectify"]
+
+
+def import_time(module):
+    # (cumulative seconds, the heavy modules that got imported)
+    script = (f"import sys; import {module}; "
+              f"print(','.join(name for name in {HEAVY_MODULES!r} if name in sys.modules))")
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", script], cwd = REPO_DIR,
+                            capture_output = True, text = True, check = True)
+
+    seconds = None
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == module:
+            seconds = int(fields[1]) / 1e6
+    heavy = [name for name in result.stdout.strip().split(",") if name]
+
+    return seconds, heavy
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Check the import time of the converter modules.")
+    parser.add_argument("--modules", nargs = "+", default = list(BUDGETS), choices = list(BUDGETS))
+    parser.add_argument("--repeat", type = int, default = 5)
+    parser.add_argument("--scale", type = float, default = 1.0, help = "multiplies every budget (slow machines)")
+    parser.add_argument("--output", default = None, help = "JSON file for the results")
+    args = parser.parse_args(argv)
+
+    results = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "modules": {}
+    }
+    over_budget = False
+    for module in args.modules:
+        runs = [import_time(module) for _ in range(args.repeat)]
+        seconds = statistics.median(run[0] for run in runs)
+        heavy = sorted(set(name for run in runs for name in run[1]))
+        budget = BUDGETS[module] * args.scale
+        passed = seconds <= budget and len(heavy) == 0
+        over_budget = over_budget or not passed
+        results["modules"][module] = {"seconds": seconds, "budget": budget, "heavy": heavy, "passed": passed}
+
+        print(f"{module:18s} {seconds * 1000:7.1f} ms (budget {budget * 1000:.0f} ms)"
+              f"{'' if len(heavy) == 0 else ' imports ' + ', '.join(heavy)}"
+              f"{'' if passed else '  FAILED'}")
+
+    if args.output is not None:
+        with open(args.output, "w") as fout:
+            json.dump(results, fout, indent = 2)
+
+    return 1 if over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
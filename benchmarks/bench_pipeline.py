@@ -0,0 +1,189 @@
+# End-to-end benchmark of `generate_leading_audios` with the stand-in
+# renderer, so it runs without MuseScore. The render cost is simulated, which
+# separates the cost of the pipeline itself from the cost of MuseScore:
+# - overhead: no simulated latency and one worker; everything that is not a
+#   render or a mix (split, instrument patches, scheduling, process startup
+#   of the stand-in) is the orchestration overhead
+# - speedup: a fixed latency per render and an increasing number of workers
+# - cache: a cold run, a run of the same score and a run after one staff was
+#   changed; the hit rate is the share of the stems that were not rendered
+# ffmpeg is still needed for the mixes.
+#
+# usage: python benchmarks/bench_pipeline.py --output bench_pipeline.json
+
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from synthetic_score import write_score
+from converter import generate_leading_audios
+from tracing import Tracer
+
+STAND_IN_RENDERER = os.path.join(BENCHMARKS_DIR, "stand_in_renderer.py")
+SCENARIOS = ["overhead", "speedup", "cache"]
+
+
+def _stand_in(latency = 0.0, realtime_factor = 0.0, ffmpeg = "ffmpeg"):
+    return [sys.executable, STAND_IN_RENDERER, "--silent", "--latency", str(latency),
+            "--realtime-factor", str(realtime_factor), "--ffmpeg", ffmpeg]
+
+
+def _run(score_filename, renderer, cache_dir = None, **conversion_args):
+    # one conversion, returns the wall time and the time spent per span category
+    tracer = Tracer()
+    start_time = time.perf_counter()
+    generate_leading_audios(input_filename = score_filename,
+                            verbose = False,
+                            renderer = renderer,
+                            use_cache = cache_dir is not None,
+                            cache_dir = cache_dir,
+                            tracer = tracer,
+                            **conversion_args)
+    wall = time.perf_counter() - start_time
+
+    categories = dict()
+    n_renders = 0
+    for span in tracer.spans:
+        # the spans of the splitter are nested in the "split" stage
+        if span.category == "split" and span.name != "split" or span.category == "instrument":
+            continue
+        categories[span.category] = categories.get(span.category, 0.0) + span.duration
+        if span.category == "render":
+            n_renders += 1 if "parts" not in span.args else len(span.args["parts"])
+
+    return {"wall": wall, "categories": categories, "renders": n_renders}
+
+
+def bench_overhead(score_filename, n_parts, conversion_args, ffmpeg, repeat = 3):
+    runs = [_run(score_filename, _stand_in(ffmpeg = ffmpeg), max_workers = 1, **conversion_args)
+            for _ in range(repeat)]
+    run = min(runs, key = lambda r: r["wall"])
+    categories = run["categories"]
+    busy = categories.get("render", 0.0) + categories.get("mix", 0.0)
+
+    return {
+        "wall": run["wall"],
+        "split": categories.get("split", 0.0),
+        "render": categories.get("render", 0.0),
+        "mix": categories.get("mix", 0.0),
+        "orchestration": run["wall"] - busy - categories.get("split", 0.0),
+        "per_part": run["wall"] / n_parts
+    }
+
+
+def bench_speedup(score_filename, workers_sweep, latency, conversion_args, ffmpeg):
+    results = []
+    for max_workers in workers_sweep:
+        run = _run(score_filename, _stand_in(latency, ffmpeg = ffmpeg), max_workers = max_workers, **conversion_args)
+        results.append({"workers": max_workers, "wall": run["wall"]})
+
+    for result in results:
+        result["speedup"] = results[0]["wall"] / result["wall"]
+
+    return results
+
+
+def _change_first_staff(score_filename):
+    # moves the first note of the first staff one semitone up
+    with open(score_filename) as fin:
+        content = fin.read()
+    content = re.sub(r"<pitch>(\d+)</pitch>", lambda m: f"<pitch>{int(m.group(1)) + 1}</pitch>", content, count = 1)
+    with open(score_filename, "w") as fout:
+        fout.write(content)
+
+
+def bench_cache(score_filename, n_parts, conversion_args, ffmpeg):
+    # every run renders 2 stems per part (background and lead) at most
+    results = []
+    cache_dir = tempfile.mkdtemp(prefix = "bench_cache_")
+    try:
+        for run_name in ["cold", "unchanged", "one staff changed"]:
+            if run_name == "one staff changed":
+                _change_first_staff(score_filename)
+            run = _run(score_filename, _stand_in(ffmpeg = ffmpeg), cache_dir = cache_dir, **conversion_args)
+            n_stems = 2 * n_parts
+            results.append({
+                "run": run_name,
+                "wall": run["wall"],
+                "renders": run["renders"],
+                "hit_rate": 1 - run["renders"] / n_stems
+            })
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors = True)
+
+    return results
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmark the whole pipeline with a stand-in renderer.")
+    parser.add_argument("--scenarios", nargs = "+", default = SCENARIOS, choices = SCENARIOS)
+    parser.add_argument("--staves", type = int, default = 4)
+    parser.add_argument("--measures", type = int, default = 32)
+    parser.add_argument("--latency", type = float, default = 0.5, help = "simulated seconds per render (speedup)")
+    parser.add_argument("--workers", nargs = "+", type = int, default = [1, 2, 4, 8])
+    parser.add_argument("--ffmpeg", default = "ffmpeg")
+    parser.add_argument("--mix-engine", choices = ["ffmpeg", "numpy"], default = "ffmpeg")
+    parser.add_argument("--batch-renders", action = "store_true")
+    parser.add_argument("--output", default = "bench_pipeline.json", help = "JSON file for the results")
+    args = parser.parse_args(argv)
+
+    conversion_args = {
+        "stem_format": "wav",
+        "output_format": "wav",
+        "mix_engine": args.mix_engine,
+        "batch_renders": args.batch_renders,
+        "ffmpeg": args.ffmpeg
+    }
+    results = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "staves": args.staves,
+        "measures": args.measures,
+        "conversion_args": conversion_args
+    }
+
+    work_dir = tempfile.mkdtemp(prefix = "bench_pipeline_")
+    try:
+        score_filename = os.path.join(work_dir, "score.mscx")
+        write_score(score_filename, n_staves = args.staves, n_measures = args.measures)
+
+        if "overhead" in args.scenarios:
+            overhead = bench_overhead(score_filename, args.staves, conversion_args, args.ffmpeg)
+            results["overhead"] = overhead
+            print(f"overhead: wall={overhead['wall']:.3f}s split={overhead['split']:.3f}s "
+                  f"render={overhead['render']:.3f}s mix={overhead['mix']:.3f}s "
+                  f"orchestration={overhead['orchestration']:.3f}s")
+
+        if "speedup" in args.scenarios:
+            results["speedup"] = bench_speedup(score_filename, args.workers, args.latency,
+                                               conversion_args, args.ffmpeg)
+            for result in results["speedup"]:
+                print(f"speedup: workers={result['workers']:3d} wall={result['wall']:.3f}s "
+                      f"speedup={result['speedup']:.2f}x")
+
+        if "cache" in args.scenarios:
+            results["cache"] = bench_cache(score_filename, args.staves, conversion_args, args.ffmpeg)
+            for result in results["cache"]:
+                print(f"cache: {result['run']:18s} wall={result['wall']:.3f}s renders={result['renders']:3d} "
+                      f"hit rate={result['hit_rate']:.0%}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors = True)
+
+    with open(args.output, "w") as fout:
+        json.dump(results, fout, indent = 2)
+
+
+if __name__ == "__main__":
+    main()
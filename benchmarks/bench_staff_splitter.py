@@ -0,0 +1,230 @@
+# Microbenchmarks for the splitter and for the instrument change.
+# Every function is measured on synthetic scores of increasing size; each
+# measurement runs in a fresh process so that the peak RSS (lxml allocates
+# outside of the Python allocator, so tracemalloc would miss most of it)
+# belongs to that measurement only. The results are written as JSON and a
+# previous result file can be passed with --compare to print the ratios.
+# The streaming splitter is also checked for memory growth: its resident
+# memory must stay flat from the first part to the end of the parse, on a
+# score with many staves and on the same score with excerpts (which follow
+# the staves), otherwise the run exits with status 1.
+#
+# usage: python benchmarks/bench_staff_splitter.py --output results.json
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from synthetic_score import write_score
+
+FUNCTIONS = ["generate_parts", "write_parts", "write_parts_streaming", "_get_tempo_elements", "_get_repeat_elements",
+             "_get_note_combination", "change_instrument", "instrument_patch"]
+
+
+def _setup(function_name, score_filename, work_dir):
+    # returns a callable running one iteration of the benchmarked function
+    import staff_splitter
+    from lxml import etree
+
+    if function_name == "generate_parts":
+        return lambda: staff_splitter.generate_parts(score_filename)
+
+    if function_name in ["write_parts", "write_parts_streaming"]:
+        streaming = function_name == "write_parts_streaming"
+        return lambda: staff_splitter.write_parts(
+            score_filename, lambda part_name: os.path.join(work_dir, f"{part_name}.mscx"),
+            streaming = streaming)
+
+    if function_name in ["_get_tempo_elements", "_get_repeat_elements"]:
+        function = getattr(staff_splitter, function_name)
+        mscx_obj = etree.parse(score_filename, staff_splitter.XML_PARSER).getroot()
+        staff_elem = mscx_obj.find("Score/Staff")
+        return lambda: function(staff_elem = staff_elem,
+                                time_map = staff_splitter.StaffTimeMap(staff_elem))
+
+    if function_name == "_get_note_combination":
+        intervals = list(range(2, 4 * staff_splitter.TICKS_PER_WHOLE, 2))
+
+        def split_intervals():
+            # cold cache: every interval is computed once
+            staff_splitter._get_note_combination.cache_clear()
+            for interval in intervals:
+                staff_splitter._get_note_combination(interval)
+        return split_intervals
+
+    if function_name == "change_instrument":
+        import converter
+        part_filename = staff_splitter.write_parts(
+            score_filename, lambda part_name: os.path.join(work_dir, f"{part_name}.mscx"))[0][1]
+        output_filename = os.path.join(work_dir, "lead.mscx")
+        converter.get_desired_instrument_json("clarinet")
+        return lambda: converter.change_instrument(part_filename, output_filename, "clarinet")
+
+    if function_name == "instrument_patch":
+        # the in-memory version of change_instrument used by the converter
+        import converter
+        part_name, part_tree = next(staff_splitter.iter_parts(score_filename))
+        patch = converter.get_instrument_patch("clarinet")
+        return lambda: patch.lead_bytes(part_tree.getroot())
+
+    raise ValueError(f"unknown benchmark '{function_name}'")
+
+
+def _measure(function_name, score_filename, repeat, queue):
+    with tempfile.TemporaryDirectory() as work_dir:
+        run_once = _setup(function_name, score_filename, work_dir)
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        timings = []
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            run_once()
+            timings.append(time.perf_counter() - start_time)
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    queue.put({
+        "seconds_min": min(timings),
+        "seconds_median": statistics.median(timings),
+        "peak_rss_kb": rss_after,
+        "peak_rss_delta_kb": rss_after - rss_before
+    })
+
+
+def _resident_kb():
+    # current resident memory; the peak RSS where /proc is not available
+    try:
+        with open("/proc/self/statm") as fin:
+            return int(fin.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _measure_streaming_growth(score_filename, queue):
+    import staff_splitter
+
+    resident_kb = [_resident_kb() for _ in staff_splitter.iter_parts(score_filename, as_bytes = True,
+                                                                     streaming = True)]
+    # the end of the parse, after the elements that follow the staves
+    resident_kb.append(_resident_kb())
+    queue.put(resident_kb)
+
+
+def check_streaming_growth(n_staves, n_measures, limit_kb, excerpts = False):
+    # resident memory after every part of the streaming splitter and at the
+    # end of the parse, measured in a fresh process; the growth from the
+    # first part must stay under `limit_kb`
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as scores_dir:
+        score_filename = os.path.join(scores_dir, f"score_{n_staves}_{n_measures}.mscx")
+        write_score(score_filename, n_staves = n_staves, n_measures = n_measures, excerpts = excerpts)
+
+        queue = context.Queue()
+        process = context.Process(target = _measure_streaming_growth, args = (score_filename, queue))
+        process.start()
+        resident_kb = queue.get()
+        process.join()
+
+    growth_kb = max(resident_kb) - resident_kb[0]
+    passed = growth_kb <= limit_kb
+    print(f"streaming growth{' (excerpts)' if excerpts else '           '} staves={n_staves:3d} measures={n_measures:5d} "
+          f"rss {resident_kb[0]}KB -> max {max(resident_kb)}KB (limit +{limit_kb}KB){'' if passed else '  FAILED'}")
+
+    return {"staves": n_staves, "measures": n_measures, "excerpts": excerpts, "resident_kb": resident_kb,
+            "growth_kb": growth_kb, "limit_kb": limit_kb, "passed": passed}
+
+
+def run_benchmarks(functions, staves_sweep, measures_sweep, repeat = 3):
+    context = multiprocessing.get_context("spawn")
+    results = []
+
+    with tempfile.TemporaryDirectory() as scores_dir:
+        for n_staves in staves_sweep:
+            for n_measures in measures_sweep:
+                score_filename = os.path.join(scores_dir, f"score_{n_staves}_{n_measures}.mscx")
+                write_score(score_filename, n_staves = n_staves, n_measures = n_measures)
+
+                for function_name in functions:
+                    queue = context.Queue()
+                    process = context.Process(target = _measure,
+                                              args = (function_name, score_filename, repeat, queue))
+                    process.start()
+                    result = queue.get()
+                    process.join()
+
+                    result.update({"function": function_name, "staves": n_staves, "measures": n_measures})
+                    results.append(result)
+                    print(f"{function_name:24s} staves={n_staves:3d} measures={n_measures:5d} "
+                          f"min={result['seconds_min'] * 1000:10.2f}ms rss+={result['peak_rss_delta_kb']:8d}KB")
+
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd = REPO_DIR,
+                              capture_output = True, check = True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous_results):
+    previous = {(r["function"], r["staves"], r["measures"]): r for r in previous_results}
+    print("\nfunction                 staves measures      before       after   ratio")
+    for result in results:
+        key = (result["function"], result["staves"], result["measures"])
+        if key not in previous:
+            continue
+        before = previous[key]["seconds_min"]
+        after = result["seconds_min"]
+        print(f"{key[0]:24s} {key[1]:6d} {key[2]:8d} {before * 1000:9.2f}ms {after * 1000:9.2f}ms "
+              f"{after / before if before > 0 else float('inf'):7.2f}")
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmark the staff splitter on synthetic scores.")
+    parser.add_argument("--functions", nargs = "+", default = FUNCTIONS, choices = FUNCTIONS)
+    parser.add_argument("--staves", nargs = "+", type = int, default = [4, 8])
+    parser.add_argument("--measures", nargs = "+", type = int, default = [32, 128, 512])
+    parser.add_argument("--repeat", type = int, default = 3)
+    parser.add_argument("--output", default = "bench_staff_splitter.json", help = "JSON file for the results")
+    parser.add_argument("--compare", default = None, help = "results of a previous run")
+    parser.add_argument("--growth-staves", type = int, default = 32, help = "staves of the streaming growth check")
+    parser.add_argument("--growth-measures", type = int, default = 256)
+    parser.add_argument("--growth-limit", type = int, default = 16 * 1024,
+                        help = "allowed growth (KB) of the streaming splitter from the first part to the end")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.functions, args.staves, args.measures, args.repeat)
+    growth = [check_streaming_growth(args.growth_staves, args.growth_measures, args.growth_limit, excerpts)
+              for excerpts in (False, True)]
+
+    with open(args.output, "w") as fout:
+        json.dump({
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": results,
+            "streaming_growth": growth
+        }, fout, indent = 2)
+
+    if args.compare is not None:
+        with open(args.compare) as fin:
+            compare(results, json.load(fin)["results"])
+
+    return 0 if all(check["passed"] for check in growth) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
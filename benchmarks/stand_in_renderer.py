@@ -0,0 +1,174 @@
+# Stand-in for the MuseScore command line, used to run and benchmark the
+# whole pipeline on machines without MuseScore. It understands the calls the
+# converter makes (`--version`, `-o output input` and `-j job_file`) and
+# writes deterministic audio with the length of the score: a tone at the
+# pitch of the first note of the score, or silence with --silent. The
+# startup and the rendering time of MuseScore can be simulated with
+# --latency (seconds per process) and --realtime-factor (seconds of
+# rendering per second of audio).
+#
+# usage, as the renderer of the converter:
+#   generate_leading_audios(..., renderer = [sys.executable, "benchmarks/stand_in_renderer.py", "--latency", "0.5"])
+
+import argparse
+import io
+import json
+import math
+import struct
+import subprocess
+import sys
+import time
+import wave
+from fractions import Fraction
+
+from lxml import etree
+
+VERSION = "stand-in renderer 1.0"
+SAMPLE_RATE = 44100
+N_CHANNELS = 2
+AMPLITUDE = 0.2
+# quarter notes per second, MuseScore's default of 120 bpm
+DEFAULT_TEMPO = 2.0
+WHOLE_DURATIONS = {
+    "whole": Fraction(1), "half": Fraction(1, 2), "quarter": Fraction(1, 4), "eighth": Fraction(1, 8),
+    "16th": Fraction(1, 16), "32nd": Fraction(1, 32), "64th": Fraction(1, 64), "128th": Fraction(1, 128),
+    "256th": Fraction(1, 256), "512th": Fraction(1, 512), "1024th": Fraction(1, 1024)
+}
+
+
+def _element_duration(elem):
+    # duration in whole notes, without the tuplet ratio
+    duration_type = elem.findtext("durationType")
+    if duration_type == "measure":
+        duration = Fraction(elem.findtext("duration"))
+    else:
+        duration = WHOLE_DURATIONS[duration_type]
+
+    dots = int(elem.findtext("dots", "0"))
+    return duration * (2 - Fraction(1, 2 ** dots))
+
+
+def score_duration(mscx_root):
+    # the length in seconds of the first staff, following its tempo markings
+    staff_elem = mscx_root.find("Score/Staff")
+    if staff_elem is None:
+        return 0.0
+
+    # (position in whole notes, quarter notes per second)
+    tempo_changes = []
+    position = Fraction(0)
+    for measure_elem in staff_elem.iterfind("Measure"):
+        measure_length = Fraction(0)
+        for voice_elem in measure_elem.iterfind("voice"):
+            voice_position = Fraction(0)
+            tuplet_ratio = Fraction(1)
+            for child in voice_elem:
+                if child.tag == "Tuplet" and child.find("actualNotes") is not None:
+                    tuplet_ratio = Fraction(int(child.findtext("normalNotes")), int(child.findtext("actualNotes")))
+                elif child.tag == "endTuplet":
+                    tuplet_ratio = Fraction(1)
+                elif child.tag == "Tempo":
+                    tempo_changes.append((position + voice_position, float(child.findtext("tempo"))))
+                elif child.tag in ("Chord", "Rest"):
+                    voice_position += _element_duration(child) * tuplet_ratio
+            measure_length = max(measure_length, voice_position)
+        position += measure_length
+
+    seconds = 0.0
+    current_position, current_tempo = Fraction(0), DEFAULT_TEMPO
+    for change_position, tempo in sorted(tempo_changes) + [(position, None)]:
+        seconds += float(change_position - current_position) * 4 / current_tempo
+        current_position = change_position
+        if tempo is not None and tempo > 0:
+            current_tempo = tempo
+
+    return seconds
+
+
+def first_pitch(mscx_root):
+    pitch = mscx_root.findtext(".//Chord/Note/pitch")
+    return None if pitch is None else int(pitch)
+
+
+def wav_bytes(seconds, pitch = None):
+    # stereo 16 bit audio; the tone is built from one whole period repeated,
+    # so even long scores are written quickly
+    n_frames = int(round(seconds * SAMPLE_RATE))
+    if pitch is None:
+        period = struct.pack("<hh", 0, 0)
+    else:
+        frequency = 440.0 * 2 ** ((pitch - 69) / 12)
+        period_frames = max(2, round(SAMPLE_RATE / frequency))
+        samples = [int(AMPLITUDE * 32767 * math.sin(2 * math.pi * k / period_frames)) for k in range(period_frames)]
+        period = b"".join(struct.pack("<hh", sample, sample) for sample in samples)
+
+    frame_size = 2 * N_CHANNELS
+    n_periods = -(-n_frames // (len(period) // frame_size))
+    frames = (period * n_periods)[:n_frames * frame_size]
+
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as fout:
+        fout.setnchannels(N_CHANNELS)
+        fout.setsampwidth(2)
+        fout.setframerate(SAMPLE_RATE)
+        fout.writeframes(frames)
+
+    return buffer.getvalue()
+
+
+def render(input_filename, output_filename, args):
+    mscx_root = etree.parse(input_filename).getroot()
+    seconds = score_duration(mscx_root)
+    if args.realtime_factor > 0:
+        time.sleep(seconds * args.realtime_factor)
+
+    audio = wav_bytes(seconds, None if args.silent else first_pitch(mscx_root))
+    if output_filename.lower().endswith(".wav"):
+        with open(output_filename, "wb") as fout:
+            fout.write(audio)
+    else:
+        # the other formats are encoded by ffmpeg, from the extension
+        subprocess.run([args.ffmpeg, "-y", "-v", "error", "-f", "wav", "-i", "pipe:0", output_filename],
+                       input = audio, check = True)
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Stand-in for the MuseScore command line.")
+    parser.add_argument("input", nargs = "?", help = "score to render")
+    parser.add_argument("-o", dest = "output", help = "audio file to write")
+    parser.add_argument("-j", dest = "job_file", help = "JSON list of {\"in\", \"out\"} jobs")
+    parser.add_argument("--version", action = "store_true")
+    parser.add_argument("--latency", type = float, default = 0.0, help = "seconds of startup")
+    parser.add_argument("--realtime-factor", type = float, default = 0.0,
+                        help = "seconds of rendering per second of audio")
+    parser.add_argument("--silent", action = "store_true", help = "write silence instead of a tone")
+    parser.add_argument("--ffmpeg", default = "ffmpeg", help = "encoder for the formats other than wav")
+    args = parser.parse_args(argv)
+
+    if args.version:
+        print(VERSION)
+        return 0
+
+    time.sleep(args.latency)
+
+    if args.job_file is not None:
+        with open(args.job_file) as fin:
+            jobs = json.load(fin)
+        status = 0
+        for job in jobs:
+            try:
+                render(job["in"], job["out"], args)
+            except (OSError, etree.XMLSyntaxError, subprocess.CalledProcessError) as error:
+                print(f"failed to render {job['in']}: {error}", file = sys.stderr)
+                status = 1
+        return status
+
+    if args.output is None or args.input is None:
+        parser.error("expected -o OUTPUT INPUT, -j JOB_FILE or --version")
+    render(args.input, args.output, args)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
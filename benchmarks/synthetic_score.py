@@ -0,0 +1,201 @@
+# Generator of synthetic MuseScore 3 (mscx) scores used by the benchmarks.
+# Every staff is a voice of a choir in 4/4. The first staff carries the
+# tempo markings, the spanners and the repeat / jump markers that the
+# splitter has to copy to every part; the other staves use longer notes so
+# that most tempo markings fall in the middle of a note and force a split.
+# Optionally, some parts have two staves (like a piano) and the score ends
+# with the excerpts MuseScore writes for generated parts: a nested Score
+# with a copy of the Part and of its staves, for every part.
+
+import argparse
+import random
+
+MEASURE_TICKS = 2048
+# (durationType, dots, ticks) used to fill the measures
+RHYTHMS_FIRST_STAFF = [("quarter", 0, 512), ("eighth", 0, 256), ("half", 0, 1024), ("quarter", 1, 768)]
+RHYTHMS_OTHER_STAVES = [("half", 0, 1024), ("whole", 0, 2048), ("half", 1, 1536)]
+TEMPO_OFFSETS = [512, 768, 1024, 1536]
+
+
+def _chord_xml(duration_type, dots, pitch, extra = ""):
+    dots_xml = f"<dots>{dots}</dots>" if dots else ""
+    return (f"<Chord>{extra}{dots_xml}<durationType>{duration_type}</durationType>"
+            f"<Note><pitch>{pitch}</pitch><tpc>14</tpc></Note></Chord>")
+
+
+def _fill_measure(rng, rhythms, pitch, breakpoints = ()):
+    # durations filling a whole measure, cut at the given breakpoints so that
+    # the first staff has a note starting at every tempo offset
+    elements = []
+    position = 0
+    stops = sorted(set(breakpoints) | {MEASURE_TICKS})
+
+    for stop in stops:
+        while position < stop:
+            fitting = [rhythm for rhythm in rhythms if position + rhythm[2] <= stop]
+            if len(fitting) == 0:
+                fitting = [("eighth", 0, 256)]
+            duration_type, dots, ticks = rng.choice(fitting)
+            elements.append((position, duration_type, dots, ticks, pitch + rng.randint(-3, 3)))
+            position += ticks
+
+    return elements
+
+
+def _tuplet_xml(tuplet_id, pitch):
+    # a triplet of eighths in the place of a quarter
+    notes = "".join(_chord_xml("eighth", 0, pitch, f"<Tuplet>{tuplet_id}</Tuplet>") for _ in range(3))
+    return (f'<Tuplet id="{tuplet_id}"><normalNotes>2</normalNotes><actualNotes>3</actualNotes>'
+            f'<baseNote>eighth</baseNote></Tuplet>{notes}<endTuplet/>')
+
+
+def generate_score(n_staves = 4,
+                   n_measures = 64,
+                   tempo_every = 4,
+                   spanner_every = 8,
+                   repeat_every = 16,
+                   jump_every = 32,
+                   tuplet_every = 5,
+                   vbox = True,
+                   two_staff_parts = (),
+                   excerpts = False,
+                   seed = 0):
+    # returns the mscx document as a string; the `*_every` arguments are
+    # measure intervals, 0 disables the element. `n_staves` is the number of
+    # parts, the parts listed in `two_staff_parts` get a second staff.
+    rng = random.Random(seed)
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<museScore version="3.02">',
+             '<Score>',
+             '<Division>480</Division>',
+             '<Style><Spatium>1.7</Spatium></Style>',
+             '<metaTag name="workTitle">Synthetic score</metaTag>',
+             '<Order id="synthetic"><instrument id="voice"/></Order>']
+
+    # the staff numbers (from 1) of every part
+    part_staves = []
+    for part_index in range(n_staves):
+        first_number = sum(len(staves) for staves in part_staves) + 1
+        part_staves.append(list(range(first_number, first_number + (2 if part_index in two_staff_parts else 1))))
+
+    def part_xml(part_index, staff_numbers):
+        name = f"Voice {part_index + 1}"
+        staves = "".join(f'<Staff id="{number}"><StaffType group="pitched"/></Staff>' for number in staff_numbers)
+        return (f'<Part>{staves}'
+                f'<trackName>{name}</trackName>'
+                f'<Instrument><longName>{name}</longName><shortName>V{part_index + 1}</shortName>'
+                f'<trackName>{name}</trackName><instrumentId>voice.soprano</instrumentId>'
+                f'<Channel><program value="52"/></Channel></Instrument></Part>')
+
+    for part_index, staff_numbers in enumerate(part_staves):
+        lines.append(part_xml(part_index, staff_numbers))
+
+    score_lines = lines
+    staff_contents = []
+    tuplet_id = 0
+    for staff_index in range(part_staves[-1][-1] if n_staves > 0 else 0):
+        first_staff = staff_index == 0
+        pitch = 72 - 5 * staff_index
+        lines = []
+        staff_contents.append(lines)
+        if first_staff and vbox:
+            lines.append('<VBox><height>10</height><Text><style>Title</style><text>Synthetic score</text></Text></VBox>')
+
+        for measure_index in range(n_measures):
+            has_tempo = first_staff and tempo_every and measure_index % tempo_every == 0
+            has_spanner = first_staff and spanner_every and measure_index % spanner_every == 1
+            has_tuplet = tuplet_every and measure_index % tuplet_every == tuplet_every - 1 and not has_tempo
+
+            tempo_offset = rng.choice(TEMPO_OFFSETS) if has_tempo else None
+            breakpoints = [tempo_offset] if has_tempo else []
+            if has_tuplet:
+                breakpoints.append(MEASURE_TICKS - 512)
+            rhythms = RHYTHMS_FIRST_STAFF if first_staff else RHYTHMS_OTHER_STAVES
+            elements = _fill_measure(rng, rhythms, pitch, breakpoints)
+
+            lines.append('<Measure>')
+            if first_staff and repeat_every and measure_index % repeat_every == 0:
+                lines.append('<startRepeat/>')
+            if first_staff and jump_every and measure_index % jump_every == jump_every // 2:
+                lines.append('<Marker><style>Repeat Text Right</style><label>segno</label></Marker>')
+
+            lines.append('<voice>')
+            if measure_index == 0:
+                lines.append('<KeySig><accidental>0</accidental></KeySig><TimeSig><sigN>4</sigN><sigD>4</sigD></TimeSig>')
+            if has_tempo and measure_index == 0:
+                lines.append('<Tempo><tempo>2</tempo><followText>1</followText><text>q = 120</text></Tempo>')
+
+            for k, (position, duration_type, dots, ticks, note_pitch) in enumerate(elements):
+                if has_tuplet and position == MEASURE_TICKS - 512:
+                    tuplet_id += 1
+                    lines.append(_tuplet_xml(tuplet_id, note_pitch))
+                    break
+                if has_tempo and position == tempo_offset:
+                    bpm = rng.choice([60, 72, 90, 108, 120])
+                    lines.append(f'<Tempo><tempo>{bpm / 60:.4f}</tempo><followText>1</followText><text>q = {bpm}</text></Tempo>')
+                if has_spanner and k == 0:
+                    lines.append('<Spanner type="GradualTempoChange"><GradualTempoChange><tempoChangeType>rallentando</tempoChangeType>'
+                                 '</GradualTempoChange><next><location><fractions>1/2</fractions></location></next></Spanner>')
+                    lines.append('<Fermata><subtype>fermataAbove</subtype><timeStretch>2</timeStretch></Fermata>')
+                lines.append(_chord_xml(duration_type, dots, note_pitch))
+            lines.append('</voice>')
+
+            if first_staff and repeat_every and measure_index % repeat_every == repeat_every - 1:
+                lines.append('<endRepeat>2</endRepeat>')
+            if first_staff and jump_every and measure_index % jump_every == jump_every - 1:
+                lines.append('<Jump><style>Repeat Text Right</style><text>D.S. al Fine</text>'
+                             '<jumpTo>segno</jumpTo><playUntil>end</playUntil><continueAt></continueAt></Jump>')
+            lines.append('</Measure>')
+
+    lines = score_lines
+    for staff_index, contents in enumerate(staff_contents):
+        lines.extend([f'<Staff id="{staff_index + 1}">'] + contents + ['</Staff>'])
+
+    if excerpts:
+        for part_index, staff_numbers in enumerate(part_staves):
+            lines.extend(['<Score>', f'<name>Voice {part_index + 1}</name>',
+                          '<Style><Spatium>1.7</Spatium></Style>',
+                          part_xml(part_index, range(1, len(staff_numbers) + 1))])
+            for k, number in enumerate(staff_numbers):
+                lines.extend([f'<Staff id="{k + 1}">'] + staff_contents[number - 1] + ['</Staff>'])
+            lines.append('</Score>')
+
+    lines.extend(['</Score>', '</museScore>'])
+
+    return "\n".join(lines)
+
+
+def write_score(output_filename, **kwargs):
+    with open(output_filename, "w") as fout:
+        fout.write(generate_score(**kwargs))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Write a synthetic mscx score.")
+    parser.add_argument("output", help = "mscx file to write")
+    parser.add_argument("--staves", type = int, default = 4)
+    parser.add_argument("--measures", type = int, default = 64)
+    parser.add_argument("--tempo-every", type = int, default = 4)
+    parser.add_argument("--spanner-every", type = int, default = 8)
+    parser.add_argument("--repeat-every", type = int, default = 16)
+    parser.add_argument("--jump-every", type = int, default = 32)
+    parser.add_argument("--tuplet-every", type = int, default = 5)
+    parser.add_argument("--no-vbox", action = "store_true")
+    parser.add_argument("--two-staff-parts", nargs = "*", type = int, default = [],
+                        help = "indices of the parts with two staves")
+    parser.add_argument("--excerpts", action = "store_true", help = "add the excerpts of the parts")
+    parser.add_argument("--seed", type = int, default = 0)
+    args = parser.parse_args()
+
+    write_score(args.output,
+                n_staves = args.staves,
+                n_measures = args.measures,
+                tempo_every = args.tempo_every,
+                spanner_every = args.spanner_every,
+                repeat_every = args.repeat_every,
+                jump_every = args.jump_every,
+                tuplet_every = args.tuplet_every,
+                vbox = not args.no_vbox,
+                two_staff_parts = args.two_staff_parts,
+                excerpts = args.excerpts,
+                seed = args.seed)
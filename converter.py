@@ -36,157 +36,529 @@ import subprocess
 import sys
 import os
 import json
-import base64
-from lxml import etree, objectify
-from time import strftime
-import xmltodict
-from staff_splitter import *
+import shutil
+import tempfile
+import threading
+from functools import lru_cache, partial
+from lxml import etree
+from staff_splitter import XML_PARSER, get_part_names, iter_parts, trim_measures
+from instrument_index import get_instrument_index
+from mixer import mix_command, mix_all_command, encoder_args, output_extension
+from numpy_mixer import mix_all_numpy
+from render_cache import DEFAULT_CACHE_DIR, RenderCache, MixManifest, get_renderer_version, render_key, mix_key
+from scheduler import StageJob, run_stage_graph, run_process, command_args
+from tracing import Tracer
 
 # musescore = r"C:\Program Files\MuseScore 3\bin\MuseScore3.exe" # windows musescore path
 musescore =  "org.musescore.MuseScore" # linux
 
+PART_XPATH = etree.XPath("Score/Part")
+
 def get_desired_instrument_json(instrument_name = "clarinet"):
-    etree_xml = etree.parse("instruments.xml")
-    exact_search_result = etree_xml.xpath(f'//Instrument[@id="{instrument_name}"]')
+    return get_instrument_index().lookup(instrument_name)
+
+class InstrumentPatch:
+    # The changes that turn a part into the lead of `instrument_name`,
+    # prepared once per instrument: instead of adding the details from
+    # instrument.xml to parts, add the details from parts to the instrument.
+    # The patch is applied to the part trees in memory and undone after the
+    # lead has been serialized, so the same tree can be patched again for
+    # another instrument.
+    def __init__(self, instrument_name = "clarinet"):
+        instrument_json = get_desired_instrument_json(instrument_name = instrument_name)
+        self.instrument_name = instrument_name
+        self.instrument_id = instrument_json["@id"]
+        self.child_texts = {tag: value for tag, value in instrument_json.items() if tag != "Channel"}
+        self.program = instrument_json["Channel"]["program"]["@value"]
+
+    def apply(self, mscx_obj):
+        # patches the mscx root and returns what is needed to `restore` it
+        style = mscx_obj.find("Score/Style")
+        saved_concert_pitch = style.find("concertPitch")
+        concert_pitch = etree.Element("concertPitch")
+        concert_pitch.text = '1'
+        if saved_concert_pitch is None:
+            style.append(concert_pitch)
+        else:
+            style.replace(saved_concert_pitch, concert_pitch)
+
+        saved_instruments = []
+        for part_elem in PART_XPATH(mscx_obj):
+            instrument_elem = part_elem.find("Instrument")
+            program_elem = instrument_elem.find("Channel/program")
+            saved_texts = []
+            for elem_child in instrument_elem:
+                if elem_child.tag in self.child_texts:
+                    saved_texts.append((elem_child, elem_child.text))
+                    elem_child.text = self.child_texts[elem_child.tag]
+            saved_instruments.append((instrument_elem, instrument_elem.get("id"),
+                                      program_elem, program_elem.get("value"), saved_texts))
+
+            instrument_elem.attrib["id"] = self.instrument_id
+            program_elem.attrib["value"] = self.program
+
+        return saved_concert_pitch, saved_instruments
+
+    def restore(self, mscx_obj, saved):
+        saved_concert_pitch, saved_instruments = saved
+        style = mscx_obj.find("Score/Style")
+        if saved_concert_pitch is None:
+            style.remove(style.find("concertPitch"))
+        else:
+            style.replace(style.find("concertPitch"), saved_concert_pitch)
+
+        for instrument_elem, instrument_id, program_elem, program, saved_texts in saved_instruments:
+            for elem_child, text in saved_texts:
+                elem_child.text = text
+            _set_or_remove(instrument_elem, "id", instrument_id)
+            _set_or_remove(program_elem, "value", program)
+
+    def lead_bytes(self, mscx_obj):
+        # the serialized lead mscx, leaving `mscx_obj` unchanged
+        saved = self.apply(mscx_obj)
+        try:
+            return etree.tostring(etree.ElementTree(mscx_obj), pretty_print = True)
+        finally:
+            self.restore(mscx_obj, saved)
 
-    if len(exact_search_result) == 0:
-        regex_search_result = etree_xml.xpath(f'(//Instrument[contains(@id, "{instrument_name}")])[1]')
-        instrument_obj = regex_search_result[0]
-    else:
-        instrument_obj = exact_search_result[0]
 
-    json_obj = xmltodict.parse(etree.tostring(instrument_obj).decode())
-    json_obj = json_obj["Instrument"]
+def _set_or_remove(elem, attribute, value):
+    if value is None:
+        elem.attrib.pop(attribute, None)
+    else:
+        elem.attrib[attribute] = value
 
-    if 'aPitchRange' in json_obj:
-        a_range = json_obj['aPitchRange'].split('-')
-        json_obj['minPitchA'] = a_range[0]
-        json_obj['maxPitchA'] = a_range[1]
 
-    if 'pPitchRange' in json_obj:
-        p_range = json_obj['pPitchRange'].split('-')
-        json_obj['minPitchP'] = p_range[0]
-        json_obj['maxPitchP'] = p_range[1]
+@lru_cache(maxsize = None)
+def get_instrument_patch(instrument_name = "clarinet"):
+    return InstrumentPatch(instrument_name)
 
-    if 'instrumentId' not in json_obj:
-        try:
-            json_obj['instrumentId'] = json_obj['musicXMLid']
-        except KeyError:
-            json_obj['instrumentId'] = "voice.soprano"
-            
-    return json_obj
 
 def change_instrument(input_filename, output_filename, desired_instrument = "clarinet"):
-    # instead of adding the details from instrument.xml to parts
-    # add the details from parts to the instrument and replace in the input mscx
-    instrument_json = get_desired_instrument_json(instrument_name = desired_instrument)
+    # file based version of `InstrumentPatch`, for a part already on disk
+    mscx_obj = etree.parse(input_filename, XML_PARSER).getroot()
+    get_instrument_patch(desired_instrument).apply(mscx_obj)
 
-    mscx_obj = objectify.parse(input_filename).getroot()
-    mscx_obj.Score.Style.concertPitch = objectify.StringElement("concertPitch")
-    mscx_obj.Score.Style.concertPitch._setText('1')
+    mscx_etree = etree.ElementTree(mscx_obj)
+    mscx_etree.write(output_filename, pretty_print = True)
 
-    for i in range(len(mscx_obj.Score.Part)):
-        mscx_obj.Score.Part[i].Instrument.attrib["id"] = instrument_json["@id"] 
-        
-        for elem_child in mscx_obj.Score.Part[i].Instrument.getchildren():
-            if elem_child.tag in instrument_json and elem_child.tag != "Channel":
-                elem_child._setText(instrument_json[elem_child.tag])
 
-        mscx_obj.Score.Part[i].Instrument.Channel.program.attrib["value"] = instrument_json["Channel"]["program"]["@value"]
+def render_batch(pairs, timeout = None, cancel_event = None, process_verbose = False, span = None, renderer = None):
+    # Renders every (mscx file, output file) pair with a single MuseScore
+    # process (or `renderer`, a command with the same command line
+    # interface), using a `-j` job file, so the renderer starts only once. The
+    # outputs the batch did not produce are rendered again one by one.
+    # Returns a dictionary output file -> "batch", "single" or the exception
+    # raised by the per-file render. `timeout` is given per file; the batch
+    # process is recorded in the tracing `span`, if given.
+    renderer = command_args(renderer or musescore)
+    for _, output_filename in pairs:
+        if os.path.exists(output_filename):
+            os.remove(output_filename)
+
+    job_fd, job_filename = tempfile.mkstemp(prefix = "musescore_job_", suffix = ".json")
+    try:
+        with os.fdopen(job_fd, "w") as fout:
+            json.dump([{"in": mscx_filename, "out": output_filename} for mscx_filename, output_filename in pairs], fout)
+
+        run_process(renderer + ['-j', job_filename],
+                    timeout = None if timeout is None else timeout * len(pairs),
+                    cancel_event = cancel_event,
+                    process_verbose = process_verbose,
+                    span = span)
+    except subprocess.SubprocessError:
+        # some files may still have been converted, they are checked below
+        pass
+    finally:
+        os.remove(job_filename)
+
+    results = dict()
+    for mscx_filename, output_filename in pairs:
+        if os.path.exists(output_filename):
+            results[output_filename] = "batch"
+            continue
+
+        if span is not None:
+            span.args.setdefault("fallback", []).append(output_filename)
+        try:
+            run_process(renderer + ['-o', output_filename, mscx_filename],
+                        timeout = timeout,
+                        cancel_event = cancel_event,
+                        process_verbose = process_verbose)
+            results[output_filename] = "single"
+        except subprocess.SubprocessError as error:
+            results[output_filename] = error
 
-    mscx_etree = etree.ElementTree(mscx_obj)
-    mscx_etree.write(output_filename, pretty_print = True)
+    return results
 
 
 def generate_leading_audios(input_filename,
                             max_weight = 3, 
                             target_instrument = "clarinet",
                             verbose = True,
-                            process_verbose = False):
+                            process_verbose = False,
+                            max_workers = None,
+                            job_timeout = None,
+                            cancel_event = None,
+                            use_cache = True,
+                            cache_dir = DEFAULT_CACHE_DIR,
+                            single_mix_process = False,
+                            mix_engine = "ffmpeg",
+                            renderer = None,
+                            ffmpeg = "ffmpeg",
+                            stem_format = "flac",
+                            keep_stems = False,
+                            output_format = "mp3",
+                            bitrate = None,
+                            batch_renders = False,
+                            n_render_batches = 1,
+                            on_stage_done = None,
+                            tracer = None,
+                            trace_filename = None,
+                            streaming_split = False,
+                            executor = None,
+                            measure_range = None,
+                            preview_parts = None):
     base_filename = os.path.basename(input_filename).split('.')[0]
     folder_path = os.path.dirname(input_filename)
 
-    if not os.path.exists(os.path.join(folder_path, "parts")):
-        os.mkdir(os.path.join(folder_path, "parts"))
-
-    if not os.path.exists(os.path.join(folder_path, "parts", "mscz")):
-        os.mkdir(os.path.join(folder_path, "parts", "mscz"))
-
-    if not os.path.exists(os.path.join(folder_path, "parts", "mp3")):
-        os.mkdir(os.path.join(folder_path, "parts", "mp3"))
+    # preview of an excerpt: every part is trimmed to the measures
+    # `measure_range` = (first, last), see `trim_measures`, and only the parts
+    # in `preview_parts` (names or indices) get a lead and a mix; the
+    # backgrounds of all the parts are still rendered, so the mixes sound as
+    # in the whole conversion. The files of a preview get their own names.
+    if measure_range is not None:
+        first_measure, last_measure = measure_range
+        base_filename += f"_m{first_measure}-{last_measure}"
+    if isinstance(preview_parts, (str, int)):
+        preview_parts = [preview_parts]
+    if preview_parts is not None:
+        # checked on the score header, before anything is split or written
+        score_part_names = get_part_names(input_filename)
+        unknown_parts = [part for part in preview_parts
+                         if part not in score_part_names and part not in range(len(score_part_names))]
+        if len(unknown_parts) > 0:
+            raise ValueError(f"unknown parts {unknown_parts}, the score has {score_part_names}")
+
+    # several scores of the same folder may be converted at the same time
+    os.makedirs(os.path.join(folder_path, "parts", "mscz"), exist_ok = True)
+
+    encoding = encoder_args(output_format, bitrate)
+    if mix_engine not in ("ffmpeg", "numpy"):
+        raise ValueError(f"unknown mix engine '{mix_engine}', expected 'ffmpeg' or 'numpy'")
+
+    if cancel_event is None:
+        cancel_event = threading.Event()
+
+    # every stage is recorded as a span of the tracer; the spans can be saved
+    # to `trace_filename` (Chrome trace-event format, or JSON lines for .jsonl)
+    if tracer is None:
+        tracer = Tracer(verbose = verbose)
+    log = tracer.log
+
+    # the renderer (MuseScore by default) and ffmpeg can be replaced by any
+    # command with the same command line interface, given as a name / path
+    # or as a list of arguments
+    renderer = command_args(renderer or musescore)
+
+    def render(output_filename, mscx_filename, timeout = None, span = None):
+        return run_process(renderer + ['-o', output_filename, mscx_filename],
+                           timeout = timeout,
+                           cancel_event = cancel_event,
+                           process_verbose = process_verbose,
+                           span = span)
         
-    # 0. check if mscx file exists
-    if os.path.basename(input_filename).split('.')[-1] == "mscz":
-        if verbose: print(f"[{strftime('%H:%M:%S')}] Convert mscz to mscx")
-        proc_output = subprocess.run([musescore, '-o', input_filename[:-1] + "x", input_filename],
-                                     capture_output = True)
-        if process_verbose: print(proc_output)
-        input_filename = input_filename[:-1] + "x"
+    # 0. mscz files are read directly by the splitter, no conversion to mscx is needed
 
     # 1. split score
-    if verbose: print(f"[{strftime('%H:%M:%S')}] Splitting score into parts")
+    log("Splitting score into parts")
     # splitter_process = subprocess.run([musescore, "--score-parts", file_path], \
                                     # capture_output = True)
-    parts_dict = generate_parts(input_filename=input_filename)
     # parts_dict = json.loads(splitter_process.stdout.decode())
-    part_names = parts_dict["parts"]
-    parts_mscx_files = [os.path.join(folder_path, "parts", "mscz", f"{part_name}_background_{base_filename}.mscx") for part_name in part_names]
-    instrument_mscx_files = [os.path.join(folder_path, "parts", "mscz", f"{part_name}_lead_{base_filename}.mscx") for part_name in part_names]
-    background_mp3_names = [os.path.join(folder_path, "parts", "mp3", f"{part_name}_background_{base_filename}.mp3") for part_name in part_names]
-    lead_mp3_names = [os.path.join(folder_path, "parts", "mp3", f"{part_name}_lead_{base_filename}.mp3") for part_name in part_names]
-
-    for i, bkg_mp3_name in enumerate(background_mp3_names):
-        # 2. generate a mscx for each part
-        if verbose: print(f"[{strftime('%H:%M:%S')}] Generate mscx file for {part_names[i]}")
-        with open(parts_mscx_files[i], "wb") as fout:
-            fout.write(base64.b64decode(parts_dict['partsBin'][i]))
-        # temp_mscx_file = parts_mscx_files[i][:-1] + 'x'
-        # proc_output = subprocess.run([musescore, '-o', temp_mscx_file, parts_mscx_files[i]],
-                                    #  capture_output = True)
-        # if process_verbose: print(proc_output)
-
-        # 3. generate bck mp3
-        if verbose: print(f"[{strftime('%H:%M:%S')}] Generate background mp3 for {part_names[i]}")
-        proc_output = subprocess.run([musescore, '-o', bkg_mp3_name, parts_mscx_files[i]],
-                                     capture_output = True)
-        if process_verbose: print(proc_output)
-
-        # 4. convert to given instrument
-        if verbose: print(f"[{strftime('%H:%M:%S')}] Change instrument for {part_names[i]}")
-        change_instrument(parts_mscx_files[i], instrument_mscx_files[i], target_instrument)
-
-        # 5. generate lead mp3
-        if verbose: print(f"[{strftime('%H:%M:%S')}] Generate lead mp3 for {part_names[i]}")
-        proc_output = subprocess.run([musescore, '-o', lead_mp3_names[i], instrument_mscx_files[i]],
-                                     capture_output = True)
-        if process_verbose: print(proc_output)
-
-    # 6. Merge lead with background
-    n_parts = len(part_names)
-
-    for i in range(n_parts):
-        if verbose: print(f"[{strftime('%H:%M:%S')}] Merge audio with lead for {part_names[i]}")
-        ffmpeg_command = ['ffmpeg', '-y', '-i', lead_mp3_names[i]]
-        final_name = os.path.join(folder_path, f"{part_names[i]}_{base_filename}.mp3")
-        weights = [f'{max_weight}']
-        
-        for j in [x for x in range(n_parts) if x != i]:
-            ffmpeg_command.append('-i')
-            ffmpeg_command.append(background_mp3_names[j])
-            weights.append(f'{max_weight-1}')
 
-        amix_string = f'amix=inputs={n_parts}:duration=longest:dropout_transition=0:weights={" ".join(weights)}'
+    # stems are cached by the content of the part they were rendered from,
+    # so only the parts that changed since the last run reach MuseScore
+    render_cache = RenderCache(cache_dir) if use_cache else None
+    mix_manifest = MixManifest(os.path.join(folder_path, "parts", f"mixes_{base_filename}.json"))
+    renderer_version = get_renderer_version(renderer) if use_cache else None
+
+    # several lead instruments and / or weights may be given as lists: the
+    # backgrounds are rendered once, the leads once per instrument, and a mix
+    # is made for every (instrument, weight) variant
+    multi_instrument = isinstance(target_instrument, (list, tuple))
+    multi_weight = isinstance(max_weight, (list, tuple))
+    instruments = list(target_instrument) if multi_instrument else [target_instrument]
+    weights = list(max_weight) if multi_weight else [max_weight]
+    variants = [(k, weight) for k in range(len(instruments)) for weight in weights]
+    multi_variant = multi_instrument or multi_weight
+
+    def lead_label(k):
+        return f"_{instruments[k]}" if multi_instrument else ""
+
+    def variant_label(k, weight):
+        return lead_label(k) + (f"_w{weight}" if multi_weight else "")
+
+    # suffixes of the job names, so that a single variant keeps the old names
+    lead_job_suffix = [f"{k}_" if multi_instrument else "" for k in range(len(instruments))]
+    mix_job_suffix = [f"{v}_" if multi_variant else "" for v in range(len(variants))]
+
+    part_names = []
+    parts_mscx_files = []
+    background_keys = []
+    # the parts that get a lead and a mix; the entries of the other parts in
+    # the lead / mix lists below are None
+    output_parts = []
+    lead_keys = [[] for _ in instruments]
+    instrument_mscx_files = [[] for _ in instruments]
+    instrument_patches = [get_instrument_patch(instrument) for instrument in instruments]
+    # the parts are produced one at a time, so only one of them is in memory;
+    # with `streaming_split` the score itself is never loaded as a whole.
+    # The leads are patched on the same in-memory tree and written directly.
+    with tracer.span("split", "split", filename = input_filename):
+        for part_name, part_tree in iter_parts(input_filename, tracer = tracer, streaming = streaming_split):
+            # 2. generate a mscx for each part
+            log(f"Generate mscx file for {part_name}")
+            if measure_range is not None:
+                with tracer.span(f"trim {part_name}", "split", part = part_name):
+                    trim_measures(part_tree.getroot(), first_measure, last_measure)
+            part_bytes = etree.tostring(part_tree, pretty_print = True)
+            i = len(part_names)
+            part_names.append(part_name)
+            parts_mscx_files.append(os.path.join(folder_path, "parts", "mscz", f"{part_name}_background_{base_filename}.mscx"))
+            with open(parts_mscx_files[-1], "wb") as fout:
+                fout.write(part_bytes)
+
+            background_keys.append(render_key(part_bytes, None, renderer_version, stem_format))
+            if preview_parts is not None and part_name not in preview_parts and i not in preview_parts:
+                for k in range(len(instruments)):
+                    lead_keys[k].append(None)
+                    instrument_mscx_files[k].append(None)
+                continue
+
+            output_parts.append(i)
+            for k, instrument in enumerate(instruments):
+                lead_keys[k].append(render_key(part_bytes, instrument, renderer_version, stem_format))
+
+                # 4. convert to given instrument
+                log(f"Change instrument to {instrument} for {part_name}")
+                with tracer.span(f"instrument {part_name}", "instrument", part = part_name, instrument = instrument):
+                    instrument_mscx_files[k].append(os.path.join(folder_path, "parts", "mscz",
+                                                                 f"{part_name}_lead{lead_label(k)}_{base_filename}.mscx"))
+                    with open(instrument_mscx_files[k][-1], "wb") as fout:
+                        fout.write(instrument_patches[k].lead_bytes(part_tree.getroot()))
 
-        ffmpeg_command.append('-filter_complex')
-        ffmpeg_command.append(amix_string)
-        ffmpeg_command.append(final_name)
-        proc_output = subprocess.run(ffmpeg_command, capture_output = True)
-        if process_verbose: print(proc_output)
+    n_parts = len(part_names)
+    if on_stage_done is not None: on_stage_done("split")
+    final_names = [[os.path.join(folder_path, f"{part_name}_{base_filename}{variant_label(k, weight)}.{output_extension(output_format)}")
+                    if i in output_parts else None
+                    for i, part_name in enumerate(part_names)] for k, weight in variants]
+
+    # the stems are rendered losslessly and only the final mixes are encoded;
+    # unless they are kept, the stems live in a temporary folder
+    if keep_stems:
+        stems_folder = os.path.join(folder_path, "parts", stem_format)
+        os.makedirs(stems_folder, exist_ok = True)
+    else:
+        stems_folder = tempfile.mkdtemp(prefix = "stems_")
+    background_stem_names = [os.path.join(stems_folder, f"{part_name}_background_{base_filename}.{stem_format}") for part_name in part_names]
+    lead_stem_names = [[os.path.join(stems_folder, f"{part_name}_lead{lead_label(k)}_{base_filename}.{stem_format}")
+                        if i in output_parts else None
+                        for i, part_name in enumerate(part_names)] for k in range(len(instruments))]
+
+    # the remaining steps form a dependency graph; every node is executed
+    # as soon as its inputs are available, on at most `max_workers` workers
+    # (or on `executor`, a pool shared with other conversions)
+    def fetch_cached_stem(i, stem_names, keys, kind):
+        if render_cache is not None and render_cache.fetch(keys[i], stem_names[i]):
+            log(f"Reuse cached {kind} stem for {part_names[i]}")
+            return True
+        return False
+
+    def render_background(i, timeout = None):
+        # 3. generate the background stem
+        if fetch_cached_stem(i, background_stem_names, background_keys, "background"):
+            return
+
+        log(f"Generate background stem for {part_names[i]}")
+        with tracer.span(f"background {part_names[i]}", "render", part = part_names[i]) as span:
+            render(background_stem_names[i], parts_mscx_files[i], timeout, span)
+        if render_cache is not None:
+            render_cache.store(background_keys[i], background_stem_names[i])
+
+    def render_lead(k, i, timeout = None):
+        # 5. generate the lead stem
+        if fetch_cached_stem(i, lead_stem_names[k], lead_keys[k], f"{instruments[k]} lead"):
+            return
+
+        log(f"Generate {instruments[k]} lead stem for {part_names[i]}")
+        with tracer.span(f"lead {part_names[i]}", "render", part = part_names[i], instrument = instruments[k]) as span:
+            render(lead_stem_names[k][i], instrument_mscx_files[k][i], timeout, span)
+        if render_cache is not None:
+            render_cache.store(lead_keys[k][i], lead_stem_names[k][i])
+
+    def render_stems_batch(indices, mscx_files, stem_names, keys, kind, timeout = None):
+        # 3. / 5. generate the stems of several parts in one MuseScore process
+        pending = [i for i in indices if not fetch_cached_stem(i, stem_names, keys, kind)]
+        if len(pending) == 0:
+            return
+
+        log(f"Generate {kind} stems for {', '.join(part_names[i] for i in pending)}")
+        with tracer.span(f"{kind} batch", "render", parts = [part_names[i] for i in pending]) as span:
+            results = render_batch([(mscx_files[i], stem_names[i]) for i in pending],
+                                   timeout = timeout,
+                                   cancel_event = cancel_event,
+                                   process_verbose = process_verbose,
+                                   span = span,
+                                   renderer = renderer)
+
+        errors = []
+        for i in pending:
+            result = results[stem_names[i]]
+            if isinstance(result, Exception):
+                log(f"Failed to generate {kind} stem for {part_names[i]}: {result}")
+                errors.append(result)
+                continue
+
+            log(f"Generated {kind} stem for {part_names[i]} ({result})")
+            if render_cache is not None:
+                render_cache.store(keys[i], stem_names[i])
+
+        if len(errors) > 0:
+            raise errors[0]
+
+    mix_keys = [[mix_key([lead_keys[k][i]] + [background_keys[j] for j in range(n_parts) if j != i], weight, encoding, mix_engine)
+                 if i in output_parts else None
+                 for i in range(n_parts)] for k, weight in variants]
+
+    def is_mix_current(v, i):
+        if render_cache is not None and mix_manifest.is_current(final_names[v][i], mix_keys[v][i]):
+            log(f"Keep unchanged mix for {part_names[i]}")
+            return True
+        return False
+
+    def mix(v, i, timeout = None):
+        # 6. Merge lead with background
+        if is_mix_current(v, i):
+            return
+
+        k, weight = variants[v]
+        log(f"Merge audio with lead for {part_names[i]}")
+        ffmpeg_command = mix_command(lead_stem_names[k][i],
+                                     [background_stem_names[j] for j in range(n_parts) if j != i],
+                                     final_names[v][i],
+                                     weight,
+                                     encoding = encoding,
+                                     ffmpeg = ffmpeg)
+        with tracer.span(f"mix {part_names[i]}", "mix", part = part_names[i]) as span:
+            run_process(ffmpeg_command,
+                        timeout = timeout,
+                        cancel_event = cancel_event,
+                        process_verbose = process_verbose,
+                        span = span)
+        mix_manifest.update(final_names[v][i], mix_keys[v][i])
+
+    def mix_all(v, timeout = None):
+        # 6. Merge every lead with the backgrounds in a single ffmpeg process,
+        # or in process with the numpy engine
+        outputs = [i for i in output_parts if not is_mix_current(v, i)]
+        if len(outputs) == 0:
+            return
+
+        k, weight = variants[v]
+        log(f"Merge audio with lead for {', '.join(part_names[i] for i in outputs)}")
+        if mix_engine == "numpy":
+            with tracer.span("mix all", "mix", parts = [part_names[i] for i in outputs]) as span:
+                mix_all_numpy(lead_stem_names[k], background_stem_names, final_names[v], weight,
+                              outputs = outputs, encoding = encoding, ffmpeg = ffmpeg,
+                              timeout = timeout, cancel_event = cancel_event, span = span)
+            for i in outputs:
+                mix_manifest.update(final_names[v][i], mix_keys[v][i])
+            return
+
+        ffmpeg_command = mix_all_command(lead_stem_names[k], background_stem_names, final_names[v],
+                                         weight, outputs = outputs, encoding = encoding, ffmpeg = ffmpeg)
+        with tracer.span("mix all", "mix", parts = [part_names[i] for i in outputs]) as span:
+            run_process(ffmpeg_command,
+                        timeout = timeout,
+                        cancel_event = cancel_event,
+                        process_verbose = process_verbose,
+                        span = span)
+        for i in outputs:
+            mix_manifest.update(final_names[v][i], mix_keys[v][i])
+
+    jobs = []
+    # name of the job producing the background / lead stem of every part
+    background_jobs = []
+    lead_jobs = []
+    if batch_renders:
+        batches = [list(range(n_parts))[b::n_render_batches] for b in range(min(n_render_batches, n_parts))]
+        for b, batch in enumerate(batches):
+            jobs.append(StageJob(f"background_batch_{b}",
+                                 partial(render_stems_batch, batch, parts_mscx_files,
+                                         background_stem_names, background_keys, "background"),
+                                 timeout = job_timeout))
+            lead_batch = [i for i in batch if i in output_parts]
+            if len(lead_batch) == 0:
+                continue
+            for k in range(len(instruments)):
+                jobs.append(StageJob(f"lead_batch_{lead_job_suffix[k]}{b}",
+                                     partial(render_stems_batch, lead_batch, instrument_mscx_files[k],
+                                             lead_stem_names[k], lead_keys[k], f"{instruments[k]} lead"),
+                                     timeout = job_timeout))
+
+        background_jobs = [f"background_batch_{i % n_render_batches}" for i in range(n_parts)]
+        lead_jobs = [[f"lead_batch_{lead_job_suffix[k]}{i % n_render_batches}" for i in range(n_parts)]
+                     for k in range(len(instruments))]
+    else:
+        for i in range(n_parts):
+            jobs.append(StageJob(f"background_{i}", partial(render_background, i),
+                                 timeout = job_timeout))
+            if i not in output_parts:
+                continue
+            for k in range(len(instruments)):
+                jobs.append(StageJob(f"lead_{lead_job_suffix[k]}{i}", partial(render_lead, k, i),
+                                     timeout = job_timeout))
+
+        background_jobs = [f"background_{i}" for i in range(n_parts)]
+        lead_jobs = [[f"lead_{lead_job_suffix[k]}{i}" for i in range(n_parts)] for k in range(len(instruments))]
+
+    for v, (k, weight) in enumerate(variants):
+        # the numpy engine always mixes all the parts at once
+        if single_mix_process or mix_engine == "numpy":
+            mix_dependencies = {lead_jobs[k][i] for i in output_parts} | set(background_jobs)
+            jobs.append(StageJob(f"mix_all_{v}" if multi_variant else "mix_all", partial(mix_all, v),
+                                 depends_on = sorted(mix_dependencies), timeout = job_timeout))
+        else:
+            for i in output_parts:
+                mix_dependencies = {lead_jobs[k][i]} | {background_jobs[j] for j in range(n_parts) if j != i}
+                jobs.append(StageJob(f"mix_{mix_job_suffix[v]}{i}", partial(mix, v, i),
+                                     depends_on = sorted(mix_dependencies), timeout = job_timeout))
+
+    try:
+        run_stage_graph(jobs, max_workers = max_workers, cancel_event = cancel_event,
+                        on_job_done = on_stage_done, executor = executor)
+    finally:
+        if not keep_stems:
+            shutil.rmtree(stems_folder, ignore_errors = True)
+        if trace_filename is not None:
+            tracer.write(trace_filename)
+
+    # the final files of the parts in `output_parts`, in the order of the score
+    final_names = [[final_names[v][i] for i in output_parts] for v in range(len(variants))]
+    if multi_variant:
+        return {(instruments[k], weight): final_names[v] for v, (k, weight) in enumerate(variants)}
+    return final_names[0]
 
 if __name__ == "__main__":
     if len(sys.argv) <= 1:
         exit("nu sunt destule argumente")
 
+    # `converter.py --daemon [--port N | --socket PATH]` serves the
+    # conversions from a long-running process, see converter_daemon.py
+    if sys.argv[1] == "--daemon":
+        from converter_daemon import main
+        sys.exit(main(sys.argv[2:]))
+
     instrument_name = "clarinet"
     max_weight = 3
     if len(sys.argv) > 2:
@@ -0,0 +1,339 @@
+# Long-running conversion service.
+# The daemon loads the instrument data and queries the renderer version
+# once, then accepts conversion jobs over a small JSON API served on
+# localhost or on a Unix socket. The jobs are queued and converted by a
+# fixed number of score workers; all the renders / mixes of the running
+# scores share one pool of stage workers, so the per-job latency is only
+# the real work.
+#
+#   POST   /jobs        {"input": "/path/score.mscz", "instrument": "flute", ...}
+#                        ("instrument" and "max_weight" may be lists;
+#                         "measures": [first, last] and "parts" for a preview)
+#   GET    /jobs        all the known jobs
+#   GET    /jobs/<id>   status of one job
+#   DELETE /jobs/<id>   cancel a job (queued or running)
+#   GET    /status      queue depth and counters
+#
+# usage: python converter_daemon.py --port 8765
+#        python converter_daemon.py --socket /tmp/converter.sock
+
+import argparse
+import itertools
+import json
+import os
+import shlex
+import socketserver
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from converter import generate_leading_audios, get_instrument_patch, musescore
+from instrument_index import get_instrument_index
+from render_cache import get_renderer_version
+from scheduler import JobCancelled, JobFailed
+
+# request field -> argument of `generate_leading_audios`
+JOB_ARGUMENTS = {
+    "instrument": "target_instrument",
+    "max_weight": "max_weight",
+    "output_format": "output_format",
+    "bitrate": "bitrate",
+    "stem_format": "stem_format",
+    "single_mix_process": "single_mix_process",
+    "mix_engine": "mix_engine",
+    "batch_renders": "batch_renders",
+    "n_render_batches": "n_render_batches",
+    "job_timeout": "job_timeout",
+    "streaming_split": "streaming_split",
+    "use_cache": "use_cache",
+    "measures": "measure_range",
+    "parts": "preview_parts"
+}
+# number of finished jobs whose status is kept
+MAX_FINISHED_JOBS = 1000
+
+
+class ConversionJob:
+    def __init__(self, job_id, input_filename, conversion_args):
+        self.job_id = job_id
+        self.input_filename = input_filename
+        self.conversion_args = conversion_args
+        self.status = "queued"
+        self.stages = []
+        self.outputs = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.cancel_event = threading.Event()
+
+    def to_dict(self):
+        return {
+            "id": self.job_id,
+            "input": self.input_filename,
+            "args": self.conversion_args,
+            "status": self.status,
+            "stages": list(self.stages),
+            "outputs": self.outputs,
+            "error": self.error,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+            "seconds": None if self.finished is None or self.started is None else self.finished - self.started
+        }
+
+
+class ConversionQueue:
+    # at most `score_workers` scores are converted at the same time, and at
+    # most `max_workers` renders / mixes run at the same time over all of them
+    def __init__(self, score_workers = 2, max_workers = None, renderer = None, ffmpeg = "ffmpeg"):
+        self.score_workers = score_workers
+        self.renderer = renderer or musescore
+        self.ffmpeg = ffmpeg
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._score_executor = ThreadPoolExecutor(max_workers = score_workers, thread_name_prefix = "score")
+        self._stage_executor = ThreadPoolExecutor(max_workers = self.max_workers, thread_name_prefix = "stage")
+        self._jobs = OrderedDict()
+        self._job_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.started = time.time()
+
+    def warm_up(self):
+        # everything that a cold CLI run pays for at every invocation
+        get_instrument_index()
+        get_renderer_version(self.renderer)
+
+    def submit(self, input_filename, conversion_args):
+        # raises ValueError for requests that cannot be converted at all
+        if not os.path.exists(input_filename):
+            raise ValueError(f"the path {input_filename} cannot be found")
+        instruments = conversion_args.get("target_instrument", "clarinet")
+        for instrument in instruments if isinstance(instruments, list) else [instruments]:
+            # the patch is what the conversion uses; the instruments with
+            # several channels are in the index but cannot be patched
+            try:
+                get_instrument_patch(instrument)
+            except KeyError as error:
+                raise ValueError(error.args[0])
+            except TypeError:
+                raise ValueError(f"the instrument '{instrument}' has several channels and cannot be used as lead")
+
+        with self._lock:
+            job = ConversionJob(str(next(self._job_ids)), input_filename, conversion_args)
+            self._jobs[job.job_id] = job
+            self._forget_finished()
+        self._score_executor.submit(self._run, job)
+
+        return job
+
+    def _run(self, job):
+        with self._lock:
+            if job.status != "queued":
+                return
+            job.status = "running"
+            job.started = time.time()
+
+        try:
+            outputs = generate_leading_audios(input_filename = job.input_filename,
+                                              verbose = False,
+                                              cancel_event = job.cancel_event,
+                                              on_stage_done = job.stages.append,
+                                              executor = self._stage_executor,
+                                              renderer = self.renderer,
+                                              ffmpeg = self.ffmpeg,
+                                              **job.conversion_args)
+        except JobCancelled:
+            status, outputs, error = "cancelled", None, None
+        except JobFailed as failure:
+            status, outputs, error = "failed", None, f"{failure.job_name}: {failure.error!r}"
+        except Exception as failure:
+            status, outputs, error = "failed", None, repr(failure)
+        else:
+            status, error = "done", None
+            if isinstance(outputs, dict):
+                # several variants, see `generate_leading_audios`
+                outputs = [{"instrument": instrument, "max_weight": weight, "outputs": names}
+                           for (instrument, weight), names in outputs.items()]
+
+        with self._lock:
+            job.status = status
+            job.outputs = outputs
+            job.error = error
+            job.finished = time.time()
+
+    def cancel(self, job_id):
+        with self._lock:
+            job = self._jobs[job_id]
+            if job.status == "queued":
+                job.status = "cancelled"
+                job.finished = time.time()
+            job.cancel_event.set()
+
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs[job_id].to_dict()
+
+    def list_jobs(self):
+        with self._lock:
+            return [job.to_dict() for job in self._jobs.values()]
+
+    def status(self):
+        with self._lock:
+            counts = {"queued": 0, "running": 0, "done": 0, "failed": 0, "cancelled": 0}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+
+        return {
+            "queue_depth": counts["queued"],
+            "jobs": counts,
+            "score_workers": self.score_workers,
+            "max_workers": self.max_workers,
+            "uptime": time.time() - self.started
+        }
+
+    def _forget_finished(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished is not None]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+    def shutdown(self):
+        with self._lock:
+            for job in self._jobs.values():
+                job.cancel_event.set()
+        self._score_executor.shutdown(wait = True, cancel_futures = True)
+        self._stage_executor.shutdown(wait = True)
+
+
+class ConverterRequestHandler(BaseHTTPRequestHandler):
+    # the queue is set on the server, see `make_server`
+    server_version = "MuseScoreStaffExporter"
+
+    def _send_json(self, status_code, content):
+        body = json.dumps(content).encode()
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _job_id(self):
+        parts = self.path.strip("/").split("/")
+        return parts[1] if len(parts) == 2 and parts[0] == "jobs" else None
+
+    def do_GET(self):
+        queue = self.server.conversion_queue
+        if self.path.rstrip("/") == "/status":
+            return self._send_json(200, queue.status())
+        if self.path.rstrip("/") == "/jobs":
+            return self._send_json(200, queue.list_jobs())
+
+        job_id = self._job_id()
+        try:
+            return self._send_json(200, queue.get(job_id))
+        except KeyError:
+            return self._send_json(404, {"error": f"unknown job {job_id}"})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            return self._send_json(404, {"error": f"unknown path {self.path}"})
+        # only JSON bodies: a web page can send a text/plain POST to localhost
+        # without a CORS preflight, but not an application/json one
+        content_type = self.headers.get("Content-Type", "").split(";")[0].strip().lower()
+        if content_type != "application/json":
+            return self._send_json(415, {"error": "the job must be sent as application/json"})
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if not isinstance(request, dict):
+                raise ValueError("the job must be a JSON object")
+            input_filename = request.pop("input")
+            unknown = sorted(set(request) - set(JOB_ARGUMENTS))
+            if len(unknown) > 0:
+                raise ValueError(f"unknown arguments {unknown}")
+            conversion_args = {JOB_ARGUMENTS[key]: value for key, value in request.items()}
+            job = self.server.conversion_queue.submit(input_filename, conversion_args)
+        except KeyError:
+            return self._send_json(400, {"error": "missing 'input'"})
+        except ValueError as error:
+            return self._send_json(400, {"error": str(error)})
+
+        return self._send_json(202, job.to_dict())
+
+    def do_DELETE(self):
+        job_id = self._job_id()
+        try:
+            job = self.server.conversion_queue.cancel(job_id)
+        except KeyError:
+            return self._send_json(404, {"error": f"unknown job {job_id}"})
+
+        return self._send_json(202, job.to_dict())
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        super().server_bind()
+
+
+def make_server(conversion_queue, host = "127.0.0.1", port = 8765, socket_path = None, verbose = False):
+    if socket_path is not None:
+        server = UnixHTTPServer(socket_path, ConverterRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), ConverterRequestHandler)
+    server.conversion_queue = conversion_queue
+    server.verbose = verbose
+
+    return server
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Serve score conversions from a long-running process.")
+    parser.add_argument("--host", default = "127.0.0.1", help = "address to listen on")
+    parser.add_argument("--port", type = int, default = 8765, help = "port to listen on")
+    parser.add_argument("--socket", default = None, help = "listen on this Unix socket instead of TCP")
+    parser.add_argument("--score-workers", type = int, default = 2, help = "number of scores converted at the same time")
+    parser.add_argument("--max-workers", type = int, default = None, help = "number of renders / mixes run at the same time")
+    # the commands are split like a shell would, so they can carry their own
+    # options, e.g. --renderer "python benchmarks/stand_in_renderer.py --latency 1"
+    parser.add_argument("--renderer", type = shlex.split, default = None, help = "MuseScore command")
+    parser.add_argument("--ffmpeg", type = shlex.split, default = ["ffmpeg"], help = "ffmpeg command")
+    parser.add_argument("--verbose", action = "store_true", help = "log every request")
+    args = parser.parse_args(argv)
+
+    conversion_queue = ConversionQueue(score_workers = args.score_workers, max_workers = args.max_workers,
+                                       renderer = args.renderer, ffmpeg = args.ffmpeg)
+    conversion_queue.warm_up()
+    server = make_server(conversion_queue, args.host, args.port, args.socket, args.verbose)
+    print(f"[{time.strftime('%H:%M:%S')}] Listening on {args.socket or f'http://{args.host}:{args.port}'}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        conversion_queue.shutdown()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
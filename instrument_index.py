@@ -0,0 +1,167 @@
+# Precompiled index over `instruments.xml`.
+# Parsing the 600+ KB xml and converting the matching element with xmltodict
+# used to happen for every part. The index converts every instrument once,
+# keeps them keyed by their `id` attribute and stores the result next to the
+# xml file, so later runs only unpickle it. The stored index is rebuilt when
+# the xml file changes (its mtime / size differ and so does its hash).
+
+import hashlib
+import os
+import pickle
+import threading
+from lxml import etree
+
+INSTRUMENTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "instruments.xml")
+INDEX_VERSION = 1
+
+_loaded_indices = dict()
+_loaded_indices_lock = threading.Lock()
+
+
+def _instrument_to_json(instrument_obj):
+    # only needed when the index is built, xmltodict pulls in urllib
+    import xmltodict
+
+    json_obj = xmltodict.parse(etree.tostring(instrument_obj).decode())
+    json_obj = json_obj["Instrument"]
+
+    if 'aPitchRange' in json_obj:
+        a_range = json_obj['aPitchRange'].split('-')
+        json_obj['minPitchA'] = a_range[0]
+        json_obj['maxPitchA'] = a_range[1]
+
+    if 'pPitchRange' in json_obj:
+        p_range = json_obj['pPitchRange'].split('-')
+        json_obj['minPitchP'] = p_range[0]
+        json_obj['maxPitchP'] = p_range[1]
+
+    if 'instrumentId' not in json_obj:
+        try:
+            json_obj['instrumentId'] = json_obj['musicXMLid']
+        except KeyError:
+            json_obj['instrumentId'] = "voice.soprano"
+
+    return json_obj
+
+
+def _file_hash(filename):
+    with open(filename, "rb") as fin:
+        return hashlib.sha1(fin.read()).hexdigest()
+
+
+class InstrumentIndex:
+    def __init__(self, instruments):
+        # `instruments` maps the instrument id to its json, in document order
+        self._instruments = instruments
+        self._ids = list(instruments)
+        self._substring_matches = dict()
+
+    def __len__(self):
+        return len(self._instruments)
+
+    def __contains__(self, instrument_name):
+        return instrument_name in self._instruments
+
+    def lookup(self, instrument_name):
+        # same semantics as the former xpath search: an exact id match first,
+        # otherwise the first instrument whose id contains the given name.
+        # The returned json is shared between calls and must not be modified.
+        instrument_json = self._instruments.get(instrument_name)
+        if instrument_json is not None:
+            return instrument_json
+
+        if instrument_name not in self._substring_matches:
+            self._substring_matches[instrument_name] = next(
+                (instrument_id for instrument_id in self._ids if instrument_name in instrument_id), None)
+
+        instrument_id = self._substring_matches[instrument_name]
+        if instrument_id is None:
+            raise KeyError(f"no instrument matching '{instrument_name}'")
+
+        return self._instruments[instrument_id]
+
+    @classmethod
+    def from_xml(cls, xml_filename = INSTRUMENTS_FILE):
+        instruments = dict()
+        for instrument_obj in etree.parse(xml_filename).iter("Instrument"):
+            instrument_id = instrument_obj.get("id")
+            # the xpath search returned the first element for duplicated ids
+            if instrument_id is not None and instrument_id not in instruments:
+                instruments[instrument_id] = _instrument_to_json(instrument_obj)
+
+        return cls(instruments)
+
+
+def _read_stored_index(index_filename):
+    try:
+        with open(index_filename, "rb") as fin:
+            stored_index = pickle.load(fin)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+        return None
+
+    if not isinstance(stored_index, dict) or stored_index.get("version") != INDEX_VERSION:
+        return None
+
+    return stored_index
+
+
+def _write_stored_index(index_filename, stored_index):
+    # a missing write permission only costs a rebuild on the next run
+    temp_filename = f"{index_filename}.{os.getpid()}.tmp"
+    try:
+        with open(temp_filename, "wb") as fout:
+            pickle.dump(stored_index, fout, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_filename, index_filename)
+    except OSError:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+
+def _load_index(xml_filename, index_filename, xml_stat):
+    stored_index = _read_stored_index(index_filename)
+
+    if stored_index is not None:
+        if stored_index["mtime_ns"] == xml_stat.st_mtime_ns and stored_index["size"] == xml_stat.st_size:
+            return InstrumentIndex(stored_index["instruments"])
+
+        xml_hash = _file_hash(xml_filename)
+        if stored_index["sha1"] == xml_hash:
+            # touched but unchanged: only refresh the stored signature
+            stored_index["mtime_ns"] = xml_stat.st_mtime_ns
+            stored_index["size"] = xml_stat.st_size
+            _write_stored_index(index_filename, stored_index)
+            return InstrumentIndex(stored_index["instruments"])
+    else:
+        xml_hash = _file_hash(xml_filename)
+
+    instrument_index = InstrumentIndex.from_xml(xml_filename)
+    _write_stored_index(index_filename, {
+        "version": INDEX_VERSION,
+        "mtime_ns": xml_stat.st_mtime_ns,
+        "size": xml_stat.st_size,
+        "sha1": xml_hash,
+        "instruments": instrument_index._instruments
+    })
+
+    return instrument_index
+
+
+def get_instrument_index(xml_filename = INSTRUMENTS_FILE, index_filename = None):
+    # returns the index for the given xml file, loading it at most once per
+    # process and as long as the xml file is not modified
+    xml_filename = os.path.abspath(xml_filename)
+    if index_filename is None:
+        index_filename = os.path.splitext(xml_filename)[0] + ".idx"
+
+    xml_stat = os.stat(xml_filename)
+    signature = (xml_stat.st_mtime_ns, xml_stat.st_size)
+
+    with _loaded_indices_lock:
+        loaded = _loaded_indices.get(xml_filename)
+        if loaded is not None and loaded[0] == signature:
+            return loaded[1]
+
+        instrument_index = _load_index(xml_filename, index_filename, xml_stat)
+        _loaded_indices[xml_filename] = (signature, instrument_index)
+
+    return instrument_index
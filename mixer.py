@@ -0,0 +1,105 @@
+# ffmpeg command lines used to merge the lead stem of a part with the
+# background stems of the other parts. The lead gets `max_weight` and every
+# background `max_weight - 1` in the `amix` filter.
+# The stems are lossless, only the final files are encoded, with one of the
+# codecs below.
+
+from scheduler import command_args
+
+# output format -> (file extension, ffmpeg codec)
+OUTPUT_CODECS = {
+    "mp3": ("mp3", "libmp3lame"),
+    "ogg": ("ogg", "libvorbis"),
+    "opus": ("opus", "libopus"),
+    "aac": ("m4a", "aac"),
+    "flac": ("flac", "flac"),
+    "wav": ("wav", "pcm_s16le")
+}
+
+
+def encoder_args(output_format = "mp3", bitrate = None):
+    # ffmpeg arguments placed before every output file
+    if output_format not in OUTPUT_CODECS:
+        raise ValueError(f"unknown output format '{output_format}', expected one of {', '.join(OUTPUT_CODECS)}")
+
+    args = ['-c:a', OUTPUT_CODECS[output_format][1]]
+    if bitrate is not None:
+        args.extend(['-b:a', str(bitrate)])
+
+    return args
+
+
+def output_extension(output_format = "mp3"):
+    return OUTPUT_CODECS[output_format][0]
+
+
+def _amix_filter(n_inputs, max_weight):
+    weights = [f'{max_weight}'] + [f'{max_weight-1}'] * (n_inputs - 1)
+    return f'amix=inputs={n_inputs}:duration=longest:dropout_transition=0:weights={" ".join(weights)}'
+
+
+def mix_command(lead_name, background_names, final_name, max_weight, encoding = (), ffmpeg = "ffmpeg"):
+    # one ffmpeg process producing the final file of a single part; `ffmpeg`
+    # is the name / path of the binary, or a list of arguments
+    ffmpeg_command = command_args(ffmpeg) + ['-y', '-i', lead_name]
+
+    for background_name in background_names:
+        ffmpeg_command.append('-i')
+        ffmpeg_command.append(background_name)
+
+    ffmpeg_command.append('-filter_complex')
+    ffmpeg_command.append(_amix_filter(len(background_names) + 1, max_weight))
+    ffmpeg_command.extend(encoding)
+    ffmpeg_command.append(final_name)
+
+    return ffmpeg_command
+
+
+def mix_all_command(lead_names, background_names, final_names, max_weight, outputs = None, encoding = (), ffmpeg = "ffmpeg"):
+    # One ffmpeg process producing the final files of all the parts listed in
+    # `outputs` (all of them by default). Every stem is decoded only once and
+    # shared between the mixes with `asplit`; each mix uses the same inputs
+    # order and `amix` weights as `mix_command`, so the results are the same.
+    n_parts = len(background_names)
+    if outputs is None:
+        outputs = list(range(n_parts))
+
+    ffmpeg_command = command_args(ffmpeg) + ['-y']
+    lead_inputs = dict()
+    for i in outputs:
+        lead_inputs[i] = len(lead_inputs)
+        ffmpeg_command.extend(['-i', lead_names[i]])
+
+    n_uses = [sum(1 for i in outputs if i != j) for j in range(n_parts)]
+    background_labels = dict()
+    filters = []
+    input_index = len(lead_inputs)
+
+    for j in range(n_parts):
+        if n_uses[j] == 0:
+            continue
+
+        ffmpeg_command.extend(['-i', background_names[j]])
+        if n_uses[j] == 1:
+            background_labels[j] = [f'[{input_index}:a]']
+        else:
+            background_labels[j] = [f'[b{j}_{k}]' for k in range(n_uses[j])]
+            filters.append(f'[{input_index}:a]asplit={n_uses[j]}{"".join(background_labels[j])}')
+        input_index += 1
+
+    for i in outputs:
+        mix_inputs = [f'[{lead_inputs[i]}:a]']
+        for j in range(n_parts):
+            if j != i:
+                mix_inputs.append(background_labels[j].pop(0))
+        filters.append(f'{"".join(mix_inputs)}{_amix_filter(n_parts, max_weight)}[mix{i}]')
+
+    ffmpeg_command.append('-filter_complex')
+    ffmpeg_command.append(';'.join(filters))
+
+    for i in outputs:
+        ffmpeg_command.extend(['-map', f'[mix{i}]'])
+        ffmpeg_command.extend(encoding)
+        ffmpeg_command.append(final_names[i])
+
+    return ffmpeg_command
@@ -0,0 +1,150 @@
+# In-process mixing engine, an alternative to the ffmpeg `amix` graphs of
+# mixer.py. Every mix is the lead of a part plus the backgrounds of all the
+# other parts, so instead of summing N - 1 backgrounds for each of the N
+# parts, the backgrounds are summed once into a bus and every mix is
+#   max_weight * lead_i + (max_weight - 1) * (bus - background_i)
+# divided by the weights of the inputs that are still playing, as `amix`
+# does with `duration=longest:dropout_transition=0`.
+# The stems are decoded once by ffmpeg into raw float samples and processed
+# in chunks of `chunk_frames`, so the memory does not grow with the length of
+# the piece; the mixes are piped into one ffmpeg encoder per output.
+
+import subprocess
+import time
+
+from scheduler import JobCancelled, command_args
+
+# every stem is decoded to this format (the MuseScore audio export format)
+SAMPLE_RATE = 44100
+N_CHANNELS = 2
+CHUNK_FRAMES = 64 * 1024
+BYTES_PER_FRAME = 4 * N_CHANNELS
+
+
+def _decoder_command(stem_name, ffmpeg):
+    return command_args(ffmpeg) + ['-v', 'error', '-i', stem_name,
+            '-f', 'f32le', '-ac', str(N_CHANNELS), '-ar', str(SAMPLE_RATE), 'pipe:1']
+
+
+def _encoder_command(final_name, encoding, ffmpeg):
+    return command_args(ffmpeg) + ['-y', '-v', 'error',
+            '-f', 'f32le', '-ac', str(N_CHANNELS), '-ar', str(SAMPLE_RATE), '-i', 'pipe:0',
+            *encoding, final_name]
+
+
+def _read_chunk(np, process, chunk, chunk_frames):
+    # fills `chunk` (frames x channels) from the decoder, returns the number
+    # of frames read; the rest of the chunk is zeroed. `np` is the numpy
+    # module, imported by `mix_all_numpy`
+    data = process.stdout.read(chunk_frames * BYTES_PER_FRAME)
+    n_frames = len(data) // BYTES_PER_FRAME
+    chunk[:n_frames] = np.frombuffer(data, dtype = "<f4", count = n_frames * N_CHANNELS).reshape(n_frames, N_CHANNELS)
+    chunk[n_frames:] = 0
+
+    return n_frames
+
+
+def mix_all_numpy(lead_names, background_names, final_names, max_weight, outputs = None, encoding = (),
+                  timeout = None, cancel_event = None, span = None, chunk_frames = CHUNK_FRAMES,
+                  ffmpeg = "ffmpeg"):
+    # Same arguments and results as running `mixer.mix_all_command`: the final
+    # files of all the parts listed in `outputs` (all of them by default).
+    # Raises JobCancelled / subprocess.TimeoutExpired like `run_process`, and
+    # CalledProcessError if a decoder or an encoder fails.
+    # numpy is only imported here, so that the converter starts without it
+    try:
+        import numpy as np
+    except ImportError:
+        raise RuntimeError("the numpy mixing engine requires numpy")
+
+    n_parts = len(background_names)
+    if outputs is None:
+        outputs = list(range(n_parts))
+    lead_weight = np.float32(max_weight)
+    background_weight = np.float32(max_weight - 1)
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    decoder_commands = ([_decoder_command(background_name, ffmpeg) for background_name in background_names] +
+                        [_decoder_command(lead_names[i], ffmpeg) for i in outputs])
+    encoder_commands = [_encoder_command(final_names[i], encoding, ffmpeg) for i in outputs]
+    decoders = []
+    encoders = []
+
+    try:
+        for command in decoder_commands:
+            decoders.append(subprocess.Popen(command, stdout = subprocess.PIPE, stderr = subprocess.DEVNULL))
+        for command in encoder_commands:
+            encoders.append(subprocess.Popen(command, stdin = subprocess.PIPE, stderr = subprocess.DEVNULL))
+        background_decoders = decoders[:n_parts]
+        lead_decoders = decoders[n_parts:]
+
+        backgrounds = np.zeros((n_parts, chunk_frames, N_CHANNELS), dtype = np.float32)
+        leads = np.zeros((len(outputs), chunk_frames, N_CHANNELS), dtype = np.float32)
+        frame_indices = np.arange(chunk_frames)
+        own_backgrounds = np.array(outputs, dtype = int)
+        n_chunks = 0
+
+        while True:
+            if cancel_event is not None and cancel_event.is_set():
+                raise JobCancelled("cancelled the numpy mix")
+            if deadline is not None and time.monotonic() > deadline:
+                raise subprocess.TimeoutExpired("numpy mix", timeout)
+
+            background_frames = np.array([_read_chunk(np, decoder, backgrounds[j], chunk_frames)
+                                          for j, decoder in enumerate(background_decoders)])
+            lead_frames = np.array([_read_chunk(np, decoder, leads[k], chunk_frames)
+                                    for k, decoder in enumerate(lead_decoders)])
+            if background_frames.max(initial = 0) == 0 and lead_frames.max(initial = 0) == 0:
+                break
+            n_chunks += 1
+
+            # the bus of all the backgrounds; every mix at once is
+            # lead + (bus - own background), normalized by the weights of the
+            # inputs that are still playing
+            bus = backgrounds.sum(axis = 0)
+            mixes = np.subtract(bus[None], backgrounds[own_backgrounds])
+            mixes *= background_weight
+            mixes += lead_weight * leads
+
+            if background_frames.min() == chunk_frames and lead_frames.min() == chunk_frames:
+                # every input is playing during the whole chunk
+                mixes *= 1 / (lead_weight + background_weight * (n_parts - 1))
+            else:
+                background_active = frame_indices[None, :] < background_frames[:, None]
+                n_background_active = background_active.sum(axis = 0)
+                active_weights = (lead_weight * (frame_indices[None, :] < lead_frames[:, None]) +
+                                  background_weight * (n_background_active[None, :] - background_active[own_backgrounds]))
+                np.divide(mixes, active_weights[:, :, None], out = mixes, where = active_weights[:, :, None] > 0)
+                mixes[active_weights <= 0] = 0
+
+            # a mix lasts as long as the longest of its inputs
+            for k, i in enumerate(outputs):
+                other_frames = np.delete(background_frames, i)
+                n_frames = max(lead_frames[k], other_frames.max(initial = 0))
+                if n_frames > 0:
+                    encoders[k].stdin.write(mixes[k, :n_frames].tobytes())
+
+        for encoder in encoders:
+            encoder.stdin.close()
+        for process, command in zip(decoders + encoders, decoder_commands + encoder_commands):
+            if process.wait() != 0:
+                raise subprocess.CalledProcessError(process.returncode, command)
+    except BaseException:
+        for process in decoders + encoders:
+            process.kill()
+        raise
+    finally:
+        for process in decoders + encoders:
+            if process.stdout is not None:
+                process.stdout.close()
+            if process.stdin is not None and not process.stdin.closed:
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+            process.wait()
+
+    if span is not None:
+        span.args["engine"] = "numpy"
+        span.args["chunks"] = n_chunks
+        span.args["argv"] = encoder_commands
@@ -0,0 +1,140 @@
+# Content-addressed cache for rendered audio.
+# A rendered stem only depends on the mscx bytes of the part, on the
+# instrument it is played with, on the MuseScore build and on the output
+# format, so these are hashed into the cache key. Entries are plain files in
+# the cache folder; a hit refreshes the entry's mtime and the least recently
+# used entries are evicted once the folder grows over `max_bytes`.
+
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import threading
+
+from scheduler import command_args
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")),
+    "musescore-staff-exporter", "renders")
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+_renderer_versions = dict()
+_renderer_versions_lock = threading.Lock()
+
+
+def get_renderer_version(renderer):
+    # the version string of the given binary (or list of arguments), queried
+    # once per process
+    command = command_args(renderer)
+    renderer = tuple(command)
+    with _renderer_versions_lock:
+        if renderer not in _renderer_versions:
+            try:
+                proc_output = subprocess.run(command + ['--version'], capture_output = True, timeout = 60)
+                version = proc_output.stdout.decode(errors = "replace").strip() or "unknown"
+            except (OSError, subprocess.SubprocessError):
+                version = "unknown"
+            _renderer_versions[renderer] = version
+
+        return _renderer_versions[renderer]
+
+
+def render_key(mscx_bytes, instrument, renderer_version, output_format):
+    # `instrument` is None for the stems that keep the original instrument
+    key_hash = hashlib.sha256()
+    key_hash.update(json.dumps([instrument, renderer_version, output_format]).encode())
+    key_hash.update(b"\0")
+    key_hash.update(mscx_bytes)
+
+    return key_hash.hexdigest()
+
+
+def mix_key(stem_keys, max_weight, encoding = (), engine = "ffmpeg"):
+    key_data = [stem_keys, max_weight, list(encoding)]
+    # the keys of the default engine are unchanged
+    if engine != "ffmpeg":
+        key_data.append(engine)
+    return hashlib.sha256(json.dumps(key_data).encode()).hexdigest()
+
+
+class RenderCache:
+    def __init__(self, cache_dir = DEFAULT_CACHE_DIR, max_bytes = DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok = True)
+
+    def _entry_path(self, key, output_format):
+        return os.path.join(self.cache_dir, f"{key}.{output_format}")
+
+    def fetch(self, key, output_filename):
+        # copies the cached audio to `output_filename`; returns False on a miss
+        output_format = os.path.splitext(output_filename)[1][1:]
+        entry_path = self._entry_path(key, output_format)
+
+        try:
+            shutil.copyfile(entry_path, output_filename)
+            os.utime(entry_path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return False
+
+        with self._lock:
+            self.hits += 1
+        return True
+
+    def store(self, key, output_filename):
+        output_format = os.path.splitext(output_filename)[1][1:]
+        entry_path = self._entry_path(key, output_format)
+        temp_path = f"{entry_path}.{threading.get_ident()}.tmp"
+
+        shutil.copyfile(output_filename, temp_path)
+        os.replace(temp_path, entry_path)
+        self.evict()
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            total_size = 0
+            for entry in os.scandir(self.cache_dir):
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    entry_stat = entry.stat()
+                    entries.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+                    total_size += entry_stat.st_size
+
+            entries.sort()
+            for _, size, path in entries:
+                if total_size <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total_size -= size
+
+
+class MixManifest:
+    # remembers which inputs produced every final file, so that a mix can be
+    # skipped when the file exists and none of its stems changed
+    def __init__(self, manifest_filename):
+        self.manifest_filename = manifest_filename
+        self._lock = threading.Lock()
+        try:
+            with open(manifest_filename) as fin:
+                self._keys = json.load(fin)
+        except (OSError, ValueError):
+            self._keys = dict()
+
+    def is_current(self, final_name, key):
+        with self._lock:
+            return os.path.exists(final_name) and self._keys.get(os.path.basename(final_name)) == key
+
+    def update(self, final_name, key):
+        with self._lock:
+            self._keys[os.path.basename(final_name)] = key
+            with open(self.manifest_filename, "w") as fout:
+                json.dump(self._keys, fout, indent = 2)
@@ -0,0 +1,227 @@
+# Small dependency-graph scheduler used by the converter pipeline.
+# Every stage of `generate_leading_audios` (render a background, change the
+# instrument, render a lead, mix a part) becomes a `StageJob` that lists the
+# jobs it depends on. A job is submitted to the worker pool as soon as all its
+# dependencies have finished, so independent renders run side by side and a
+# mix starts the moment its own stems exist.
+#
+# The workers are threads: the heavy lifting is done by MuseScore / ffmpeg
+# child processes, so the GIL is not a bottleneck here.
+
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+POLL_INTERVAL = 0.2
+
+
+def command_args(command):
+    # a command is the name / path of an executable, or the list of its
+    # first arguments (like an interpreter and a script)
+    return [command] if isinstance(command, str) else list(command)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobFailed(Exception):
+    def __init__(self, job_name, error):
+        super().__init__(f"job '{job_name}' failed: {error!r}")
+        self.job_name = job_name
+        self.error = error
+
+
+class StageJob:
+    def __init__(self, name, func, depends_on = (), timeout = None):
+        # `func` is called with a single keyword argument, `timeout`, and its
+        # return value is stored as the job result
+        self.name = name
+        self.func = func
+        self.depends_on = list(depends_on)
+        self.timeout = timeout
+
+    def __repr__(self):
+        return f"StageJob({self.name!r}, depends_on={self.depends_on!r})"
+
+
+def _rusage_popen_class():
+    # Popen that reaps the child with os.wait4 to keep its resource usage
+    # (CPU time and peak RSS) in `rusage`. This overrides `Popen._try_wait`,
+    # a private CPython method with the same signature since Python 3.3;
+    # where it or os.wait4 is missing, the plain Popen is used and no
+    # resource usage is recorded.
+    if not hasattr(os, "wait4") or not hasattr(subprocess.Popen, "_try_wait"):
+        return subprocess.Popen
+
+    class _RusagePopen(subprocess.Popen):
+        rusage = None
+
+        def _try_wait(self, wait_flags):
+            try:
+                (pid, sts, rusage) = os.wait4(self.pid, wait_flags)
+            except ChildProcessError:
+                return (self.pid, 0)
+            if pid != 0:
+                self.rusage = rusage
+            return (pid, sts)
+
+    return _RusagePopen
+
+
+_Popen = _rusage_popen_class()
+
+
+def run_process(args, timeout = None, cancel_event = None, process_verbose = False, span = None):
+    # subprocess.run replacement that can be interrupted by the scheduler:
+    # the child is killed when the timeout expires or when the cancel event
+    # is set by another failing job. The argv, exit code and resource usage
+    # of the child are recorded in the tracing `span`, if given, also when
+    # the child was killed.
+    process = _Popen(args, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    stderr = None
+
+    try:
+        while True:
+            try:
+                stdout, stderr = process.communicate(timeout = POLL_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                if cancel_event is not None and cancel_event.is_set():
+                    if span is not None: span.args["killed"] = "cancelled"
+                    process.kill()
+                    _, stderr = process.communicate()
+                    raise JobCancelled(f"cancelled {args[0]}")
+                if deadline is not None and time.monotonic() > deadline:
+                    if span is not None: span.args["killed"] = "timeout"
+                    process.kill()
+                    stdout, stderr = process.communicate()
+                    raise subprocess.TimeoutExpired(args, timeout, stdout, stderr)
+    finally:
+        if process.returncode is None:
+            # interrupted (Ctrl+C): the child must not outlive the job
+            process.kill()
+            process.wait()
+        if span is not None:
+            span.record_process(args, process.returncode, getattr(process, "rusage", None))
+            if process.returncode != 0 and stderr is not None:
+                span.args["stderr"] = stderr[-2000:].decode(errors = "replace")
+
+    proc_output = subprocess.CompletedProcess(args, process.returncode, stdout, stderr)
+    if process_verbose: print(proc_output)
+    proc_output.check_returncode()
+
+    return proc_output
+
+
+def _check_graph(jobs):
+    names = set()
+    for job in jobs:
+        if job.name in names:
+            raise ValueError(f"duplicated job name '{job.name}'")
+        names.add(job.name)
+
+    for job in jobs:
+        for dependency in job.depends_on:
+            if dependency not in names:
+                raise ValueError(f"job '{job.name}' depends on unknown job '{dependency}'")
+
+    # Kahn's algorithm, only used to reject cycles before anything is started
+    n_missing = {job.name: len(job.depends_on) for job in jobs}
+    dependents = {job.name: [] for job in jobs}
+    for job in jobs:
+        for dependency in job.depends_on:
+            dependents[dependency].append(job.name)
+
+    ready = [name for name, count in n_missing.items() if count == 0]
+    n_visited = 0
+    while ready:
+        name = ready.pop()
+        n_visited += 1
+        for dependent in dependents[name]:
+            n_missing[dependent] -= 1
+            if n_missing[dependent] == 0:
+                ready.append(dependent)
+
+    if n_visited != len(jobs):
+        raise ValueError("the job graph contains a cycle")
+
+    return dependents
+
+
+def run_stage_graph(jobs, max_workers = None, cancel_event = None, on_job_done = None, executor = None):
+    # Runs the jobs respecting their dependencies and returns a dictionary
+    # job name -> result. On the first failure (or on Ctrl+C) the cancel event
+    # is set, no new job is started, running children are killed and the
+    # error is raised as `JobFailed`. `on_job_done(job_name)` is called after
+    # every successful job.
+    # The jobs run on `executor` if given (a pool shared by several graphs,
+    # left running afterwards), otherwise on a pool of `max_workers` threads.
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if cancel_event is None:
+        cancel_event = threading.Event()
+
+    dependents = _check_graph(jobs)
+    jobs_by_name = {job.name: job for job in jobs}
+    n_missing = {job.name: len(job.depends_on) for job in jobs}
+    results = dict()
+    failure = None
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers = max_workers)
+    running = dict()
+
+    def submit(job_name):
+        job = jobs_by_name[job_name]
+        running[executor.submit(job.func, timeout = job.timeout)] = job_name
+
+    try:
+        for name, count in n_missing.items():
+            if count == 0:
+                submit(name)
+
+        while running:
+            done, _ = wait(running, return_when = FIRST_COMPLETED)
+
+            for future in done:
+                job_name = running.pop(future)
+                error = future.exception()
+
+                if error is not None:
+                    if failure is None and not isinstance(error, JobCancelled):
+                        failure = JobFailed(job_name, error)
+                    cancel_event.set()
+                    continue
+
+                results[job_name] = future.result()
+                if on_job_done is not None:
+                    on_job_done(job_name)
+                if cancel_event.is_set():
+                    continue
+
+                for dependent in dependents[job_name]:
+                    n_missing[dependent] -= 1
+                    if n_missing[dependent] == 0:
+                        submit(dependent)
+    except BaseException:
+        cancel_event.set()
+        raise
+    finally:
+        if own_executor:
+            executor.shutdown(wait = True, cancel_futures = True)
+        else:
+            for future in running:
+                future.cancel()
+            wait(running)
+
+    if failure is not None:
+        raise failure
+    if cancel_event.is_set():
+        raise JobCancelled("the job graph was cancelled")
+
+    return results
@@ -1,65 +1,147 @@
-from lxml import etree, objectify
+from lxml import etree
 from copy import deepcopy
+from bisect import bisect_left, bisect_right
+from fractions import Fraction
+from functools import lru_cache
+from contextlib import contextmanager, nullcontext
 import base64
+import zipfile
 
-from sympy import true
+# the parser used for the scores and the generated elements; the blank text
+# is removed so that the parts are pretty printed
+XML_PARSER = etree.XMLParser(remove_blank_text=True)
 
-INF = 10000000
+# the elements of the first staff copied to every part
+TEMPO_CANDIDATES_XPATH = etree.XPath(".//*[self::Tempo or self::Spanner]")
+REPEAT_CANDIDATES_XPATH = etree.XPath(
+    ".//*[self::Marker or self::startRepeat or self::endRepeat or self::Jump]")
+
+# the elements whose last occurrence before a measure range is still in
+# effect at its start, in the order in which MuseScore writes them
+STATE_TAGS = ["Clef", "KeySig", "TimeSig", "Tempo", "Dynamic"]
+
+MIN_DURATION = 1024
+STREAMING_CHUNK_SIZE = 64 * 1024
+# durations are integer ticks; a whole note has twice the ticks of the
+# shortest note, so that a dotted 1024th is still a whole number
+TICKS_PER_WHOLE = MIN_DURATION * 2
 NOTES_DURATIONS_DICT = {
-    "whole": 1,
-    "half": 1/2,
-    "quarter": 1/4,
-    "eighth": 1/8,
-    "16th": 1/16,
-    "32nd": 1/32,
-    "64th": 1/64,
-    "128th": 1/128,
-    "256th": 1/256,
-    "512th": 1/512,
-    "1024th": 1/1024
+    "whole": TICKS_PER_WHOLE,
+    "half": TICKS_PER_WHOLE // 2,
+    "quarter": TICKS_PER_WHOLE // 4,
+    "eighth": TICKS_PER_WHOLE // 8,
+    "16th": TICKS_PER_WHOLE // 16,
+    "32nd": TICKS_PER_WHOLE // 32,
+    "64th": TICKS_PER_WHOLE // 64,
+    "128th": TICKS_PER_WHOLE // 128,
+    "256th": TICKS_PER_WHOLE // 256,
+    "512th": TICKS_PER_WHOLE // 512,
+    "1024th": TICKS_PER_WHOLE // 1024
 }
 for key, value in list(NOTES_DURATIONS_DICT.items()):
-    NOTES_DURATIONS_DICT["dot_" + key] = value * 3/2
+    NOTES_DURATIONS_DICT["dot_" + key] = value * 3 // 2
 NOTE_DURATION_TUPLES = [(key, value)
                         for key, value in NOTES_DURATIONS_DICT.items()]
 NOTE_DURATION_TUPLES.sort(key=lambda x: x[1])
 NOTE_DURATIONS = [note[1] for note in NOTE_DURATION_TUPLES]
 N_NOTE_TYPES = len(NOTE_DURATIONS)
-MIN_DURATION = 1024
-
-
-def _get_passed_duration(tempo_position):
-    total_duration = 0
 
-    sibling = tempo_position.getprevious()
-    while sibling is not None:
-        if sibling.tag in ["Rest", "Chord"]:
-            duration_string = sibling.durationType.text
-            if duration_string == "measure":
-                fraction_elem = [int(x)
-                                 for x in sibling.duration.text.split("/")]
-                duration = fraction_elem[0] / fraction_elem[1]
-            else:
-                duration = NOTES_DURATIONS_DICT[duration_string]
-
-            if hasattr(sibling, 'dots') and sibling.dots.text == "1":
-                duration = duration * 3 / 2
-
-            total_duration += duration
 
-        sibling = sibling.getprevious()
+def _fraction_to_ticks(fraction_string):
+    numerator, denominator = [int(x) for x in fraction_string.split("/")]
+    ticks, remainder = divmod(numerator * TICKS_PER_WHOLE, denominator)
+    if remainder != 0:
+        raise ValueError(f"the duration {fraction_string} cannot be expressed in ticks")
 
-    return total_duration
+    return ticks
 
 
-def _get_tempo_elements(mscore_xml_object):
+def _get_element_duration(elem):
+    duration_string = elem.findtext("durationType")
+    if duration_string == "measure":
+        duration = _fraction_to_ticks(elem.findtext("duration"))
+    else:
+        duration = NOTES_DURATIONS_DICT[duration_string]
+
+    if elem.findtext("dots") == "1":
+        duration = duration * 3 // 2
+
+    return duration
+
+
+class StaffTimeMap:
+    # Positions of the elements of a staff, computed in a single pass:
+    # - `measure_indices` maps every Measure to its index among the staff children
+    # - `measure_starts` maps the same index to the measure's start (the
+    #   longest voice of the previous measures)
+    # - `onsets` / `chords_rests` hold, per measure index, the Chord and Rest
+    #   elements of the measure in document order and their cumulative onsets
+    # - `voice_onsets` maps every other child of a voice (Tempo, Spanner, ...)
+    #   to the duration passed in its voice before it
+    def __init__(self, staff_elem):
+        self.measure_indices = dict()
+        self.measure_starts = dict()
+        self.onsets = dict()
+        self.chords_rests = dict()
+        self.voice_onsets = dict()
+
+        measure_start = 0
+        for measure_index, measure_elem in enumerate(staff_elem.iterchildren()):
+            if measure_elem.tag != "Measure":
+                continue
+
+            self.measure_indices[measure_elem] = measure_index
+            self.measure_starts[measure_index] = measure_start
+            onsets = []
+            chords_rests = []
+            current_duration = 0
+            measure_duration = 0
+
+            for voice_elem in measure_elem.iterchildren("voice"):
+                voice_duration = 0
+                for voice_child in voice_elem.iterchildren():
+                    if voice_child.tag in ["Rest", "Chord"]:
+                        duration = _get_element_duration(voice_child)
+                        onsets.append(current_duration)
+                        chords_rests.append(voice_child)
+                        current_duration += duration
+                        voice_duration += duration
+                    else:
+                        self.voice_onsets[voice_child] = voice_duration
+
+                measure_duration = max(measure_duration, voice_duration)
+
+            self.onsets[measure_index] = onsets
+            self.chords_rests[measure_index] = chords_rests
+            measure_start += measure_duration
+
+    def find(self, measure_index, passed_duration):
+        # index of the Chord / Rest of the measure that starts at or contains
+        # the given position
+        onsets = self.onsets[measure_index]
+        position = bisect_left(onsets, passed_duration)
+        if position < len(onsets) and onsets[position] == passed_duration:
+            return position
+
+        return position - 1
+
+    def replace(self, measure_index, position, new_elements):
+        # updates the map after a Chord / Rest was split into `new_elements`
+        onsets = self.onsets[measure_index]
+        new_onsets = []
+        current_duration = onsets[position]
+        for elem in new_elements:
+            new_onsets.append(current_duration)
+            current_duration += _get_element_duration(elem)
+
+        onsets[position:position+1] = new_onsets
+        self.chords_rests[measure_index][position:position+1] = new_elements
+
+
+def _get_tempo_elements(staff_elem, time_map):
     output_dictionary = dict()
-    tempo_tag_names = ["Tempo", "Spanner"]
-    search_string = " or ".join(
-        ["self::" + tag_name for tag_name in tempo_tag_names])
     output_dictionary["tempo_elements"] = []
-    candidates = mscore_xml_object.Score.Staff[0].xpath(
-        f".//*[{search_string}]")
+    candidates = TEMPO_CANDIDATES_XPATH(staff_elem)
     output_dictionary["measure_indices"] = []
     output_dictionary["location_inside_measure"] = []
     output_dictionary["duration_passed"] = []
@@ -70,41 +152,30 @@ def _get_tempo_elements(mscore_xml_object):
         if measure_parent.tag == "Measure":
             output_dictionary["tempo_elements"].append(temp_elem)
             output_dictionary["duration_passed"].append(
-                _get_passed_duration(temp_elem))
+                time_map.voice_onsets[temp_elem])
             output_dictionary["measure_indices"].append(
-                mscore_xml_object.Score.Staff[0].index(measure_parent))
+                time_map.measure_indices[measure_parent])
             output_dictionary["location_inside_measure"].append(
                 temp_elem.getparent().index(temp_elem))
 
     return output_dictionary
 
+@lru_cache(maxsize=None)
 def _get_note_combination(interval):
-    # DP approach works only with integers, thus the intervals must be converted to whole numbers
-    int_interval = int(interval * MIN_DURATION * 2)
-    note_durations = [int(note * MIN_DURATION * 2) for note in NOTE_DURATIONS]
-    note_durations.insert(0, 0)
-
-    M = [0]*(int_interval+1)
-    S = [0]*(int_interval+1)
-
-    for j in range(1, int_interval+1):
-        minimum = INF
-        note = 0
-
-        for i in range(1, N_NOTE_TYPES+1):
-            if(j >= note_durations[i]):
-                minimum = min(minimum, 1+M[j-note_durations[i]])
-                note = i
-        M[j] = minimum
-        S[j] = note 
-
-    l = int_interval
+    # splits an interval (in ticks) into note types, taking the longest note
+    # that fits first; the same intervals come back for every part, so the
+    # decompositions are memoized
     note_combination = []
-    while(l > 0):
-        note_combination.append(NOTE_DURATION_TUPLES[S[l]-1][0])
-        l = l-note_durations[S[l]]
+    remaining = interval
+    while remaining > 0:
+        note_index = bisect_right(NOTE_DURATIONS, remaining) - 1
+        if note_index < 0:
+            raise ValueError(f"the interval {interval} cannot be split into notes")
+
+        note_combination.append(NOTE_DURATION_TUPLES[note_index][0])
+        remaining -= NOTE_DURATIONS[note_index]
 
-    return note_combination
+    return tuple(note_combination)
 
 def _generate_rest_xml(duration_list):
     rest_list = []
@@ -113,20 +184,13 @@ def _generate_rest_xml(duration_list):
             xml_string = f"<Rest><dots>1</dots><durationType>{duration[4:]}</durationType></Rest>"
         else:
             xml_string = f"<Rest><durationType>{duration}</durationType></Rest>"
-        rest_list.append(objectify.XML(xml_string))
+        rest_list.append(etree.fromstring(xml_string, XML_PARSER))
         
     return rest_list
 
 def _get_fraction_string(duration):
-    eps = 1e-8
-    fact = 1
-    
-    while True:
-        if abs(int(duration) - duration) < eps:
-            return f"{int(duration)}/{fact}"
-        
-        fact = fact * 2
-        duration = duration * 2
+    fraction = Fraction(duration, TICKS_PER_WHOLE)
+    return f"{fraction.numerator}/{fraction.denominator}"
     
 def _generate_rest_xml(duration_list):
     rest_list = []
@@ -135,7 +199,7 @@ def _generate_rest_xml(duration_list):
             xml_string = f"<Rest><dots>1</dots><durationType>{duration[4:]}</durationType></Rest>"
         else:
             xml_string = f"<Rest><durationType>{duration}</durationType></Rest>"
-        rest_list.append(objectify.XML(xml_string))
+        rest_list.append(etree.fromstring(xml_string, XML_PARSER))
 
     return rest_list
 
@@ -152,13 +216,13 @@ def _generate_note_xml(duration_list, note_template):
     for i, duration in enumerate(duration_list):
         new_note = deepcopy(note_template)
         if duration.startswith("dot_"):
-            new_note.insert(0, objectify.XML("<dots>1</dots>")) 
-            new_note.durationType._setText(duration[4:])
+            new_note.insert(0, etree.fromstring("<dots>1</dots>", XML_PARSER)) 
+            new_note.find("durationType").text = duration[4:]
         else:
-            new_note.durationType._setText(duration)
+            new_note.find("durationType").text = duration
 
         duration_int = NOTES_DURATIONS_DICT[duration]
-        spanner_start = objectify.XML(f"""
+        spanner_start = etree.fromstring(f"""
         <Spanner type="Tie">
             <Tie></Tie>
             <next>
@@ -167,9 +231,9 @@ def _generate_note_xml(duration_list, note_template):
                 </location>
             </next>
         </Spanner>    
-        """)
+        """, XML_PARSER)
 
-        spanner_stop = objectify.XML(f"""
+        spanner_stop = etree.fromstring(f"""
         <Spanner type="Tie">
             <prev>
                 <location>
@@ -177,76 +241,64 @@ def _generate_note_xml(duration_list, note_template):
                 </location>
             </prev>
         </Spanner>    
-        """)
+        """, XML_PARSER)
 
         prev_duration = duration_int
 
         if i > 0:
-            new_note.Note.insert(0, spanner_stop)
+            new_note.find("Note").insert(0, spanner_stop)
         if i < n_notes - 1:
-            new_note.Note.insert(0, spanner_start)
+            new_note.find("Note").insert(0, spanner_start)
 
         note_list.append(new_note)
 
     return note_list 
 
-def _get_note_for_tempo(measure_elem, passed_duration):
-    chords_rests_elems = measure_elem.xpath(".//*[self::Chord or self::Rest]")
-
-    current_duration = 0
-
-    for note_elem in chords_rests_elems:
-        if current_duration == passed_duration:
-            stop_note = note_elem
-            break
+def _get_note_for_tempo(time_map, measure_index, passed_duration):
+    position = time_map.find(measure_index, passed_duration)
+    if position < 0:
+        raise ValueError(f"no note found at {passed_duration} in measure {measure_index}")
 
-        duration_string = note_elem.durationType.text
+    note_elem = time_map.chords_rests[measure_index][position]
+    note_onset = time_map.onsets[measure_index][position]
 
-        if duration_string == "measure":
-            fraction_elem = [int(x)
-                             for x in note_elem.duration.text.split("/")]
-            duration = fraction_elem[0] / fraction_elem[1]
-        else:
-            duration = NOTES_DURATIONS_DICT[duration_string]
+    if note_onset == passed_duration:
+        return note_elem
 
-        if hasattr(note_elem, 'dots') and note_elem.dots.text == "1":
-            duration = duration * 3 / 2
+    duration = _get_element_duration(note_elem)
+    current_duration = note_onset + duration
+    if current_duration <= passed_duration:
+        raise ValueError(f"no note found at {passed_duration} in measure {measure_index}")
 
-        current_duration += duration
+    durations_before = _get_note_combination(passed_duration - note_onset)
+    parent_elem = note_elem.getparent()
+    index_elem = parent_elem.index(note_elem)
+    parent_elem.remove(note_elem) 
 
-        if current_duration > passed_duration:
-            durations_before = _get_note_combination(passed_duration + duration - current_duration)
-            parent_elem = note_elem.getparent()
-            index_elem = parent_elem.index(note_elem)
-            parent_elem.remove(note_elem) 
+    durations_after = _get_note_combination(current_duration - passed_duration)
+    if note_elem.tag == "Rest":
+        elements_after = _generate_rest_xml(durations_after)  
+        elements_before = _generate_rest_xml(durations_before)
+    else:
+        elements_after = _generate_note_xml(durations_after, note_elem)
+        elements_before = _generate_note_xml(durations_before, note_elem)
 
-            durations_after = _get_note_combination(current_duration - passed_duration)
-            if note_elem.tag == "Rest":
-                elements_after = _generate_rest_xml(durations_after)  
-                elements_before = _generate_rest_xml(durations_before)
-            else:
-                elements_after = _generate_note_xml(durations_after, note_elem)
-                elements_before = _generate_note_xml(durations_before, note_elem)
+    stop_note = elements_after[0]
 
-            stop_note = elements_after[0]
+    for elem in elements_after[::-1]:
+        parent_elem.insert(index_elem, elem)
 
-            for elem in elements_after[::-1]:
-                parent_elem.insert(index_elem, elem)
+    for elem in elements_before[::-1]:
+        parent_elem.insert(index_elem, elem)
 
-            for elem in elements_before[::-1]:
-                parent_elem.insert(index_elem, elem)
-            break
+    time_map.replace(measure_index, position, elements_before + elements_after)
         
     return stop_note
 
 
-def _get_repeat_elements(mscore_xml_object):
+def _get_repeat_elements(staff_elem, time_map):
     output_dictionary = dict()
-    repeat_tag_names = ["Marker", "startRepeat", "endRepeat", "Jump"]
-    search_string = " or ".join(
-        ["self::" + tag_name for tag_name in repeat_tag_names])
-    candidates = mscore_xml_object.Score.Staff[0].xpath(
-        f".//*[{search_string}]")
+    candidates = REPEAT_CANDIDATES_XPATH(staff_elem)
     output_dictionary["measure_indices"] = []
     output_dictionary["location_inside_measure"] = []
     output_dictionary["repeat_elements"] = []
@@ -257,68 +309,416 @@ def _get_repeat_elements(mscore_xml_object):
         if measure_parent.tag == "Measure":
             output_dictionary["repeat_elements"].append(repeat_elem)
             output_dictionary["measure_indices"].append(
-                mscore_xml_object.Score.Staff[0].index(measure_parent))
+                time_map.measure_indices[measure_parent])
             output_dictionary["location_inside_measure"].append(
                 measure_parent.index(repeat_elem))
 
     return output_dictionary
 
 
-def generate_parts(input_filename):
-    mscx_obj = objectify.parse(input_filename).getroot()
-    output_dictionary = {
-        "parts": [],
-        "partsBin": []
-    }
+def _trace(tracer, name, **args):
+    if tracer is None:
+        return nullcontext()
+    return tracer.span(name, "split", **args)
+
 
-    mscx_obj.Score.metaTag = objectify.StringElement(
-        "metaTag", name="partName")
+def _get_part_name(part_elem, part_index):
+    long_name_elem = part_elem.find("Instrument/longName")
+    if long_name_elem is not None:
+        return long_name_elem.text
+    return f"Instrument_{part_index}"
 
-    parts = deepcopy(mscx_obj.Score.Part[:])
-    staffs = deepcopy(mscx_obj.Score.Staff[:])
-    n_parts = len(parts)
-    repeat_elements_dict = _get_repeat_elements(mscore_xml_object=mscx_obj)
-    tempo_elements_dict = _get_tempo_elements(mscore_xml_object=mscx_obj)
 
-    if hasattr(mscx_obj.Score.Staff[0], 'VBox'):
-        vbox_element = mscx_obj.Score.Staff[0].VBox
+def _get_first_staff_markers(staff_elem):
+    # the elements of the first staff that every part needs: the VBox (title)
+    # and the tempo / repeat markers
+    time_map = StaffTimeMap(staff_elem)
+    repeat_elements_dict = _get_repeat_elements(staff_elem=staff_elem,
+                                                time_map=time_map)
+    tempo_elements_dict = _get_tempo_elements(staff_elem=staff_elem,
+                                              time_map=time_map)
+
+    vbox_element = staff_elem.find("VBox")
+
+    return vbox_element, tempo_elements_dict, repeat_elements_dict
+
+
+def _insert_first_staff_markers(staff_elem, vbox_element, tempo_elements_dict, repeat_elements_dict):
+    # moves the first staff markers into the staff of another part
+    if vbox_element is not None:
+        staff_elem.insert(0, vbox_element)
+
+    staff_children = staff_elem.getchildren()
+    time_map = StaffTimeMap(staff_elem)
+    for j, measure_index in enumerate(tempo_elements_dict["measure_indices"]):
+        # staff_children[measure_index].voice.insert(tempo_elements_dict["location_inside_measure"][j],
+                                                #    tempo_elements_dict["tempo_elements"][j])
+
+        note_element = _get_note_for_tempo(
+            time_map, measure_index, tempo_elements_dict["duration_passed"][j])
+        note_element.addprevious(tempo_elements_dict["tempo_elements"][j])
+
+    for j, measure_index in enumerate(repeat_elements_dict["measure_indices"]):
+        staff_children[measure_index].insert(repeat_elements_dict["location_inside_measure"][j],
+                                             repeat_elements_dict["repeat_elements"][j])
+
+
+def _get_mscz_score_name(archive):
+    # the main mscx of a mscz archive, as listed in META-INF/container.xml;
+    # otherwise the first mscx, preferring the ones outside of any folder
+    try:
+        container = etree.fromstring(archive.read("META-INF/container.xml"))
+        for rootfile in container.iter("rootfile"):
+            if rootfile.get("full-path", "").endswith(".mscx"):
+                return rootfile.get("full-path")
+    except (KeyError, etree.XMLSyntaxError):
+        pass
+
+    score_names = [name for name in archive.namelist() if name.endswith(".mscx")]
+    top_level_names = [name for name in score_names if "/" not in name]
+    if len(top_level_names + score_names) > 0:
+        return (top_level_names + score_names)[0]
+
+    raise ValueError(f"no mscx score found in {archive.filename}")
+
+
+@contextmanager
+def open_score(input_filename):
+    # binary file object with the mscx content of a mscx or mscz file; the
+    # mscx inside a mscz archive is decompressed while it is read
+    if input_filename.lower().endswith(".mscz"):
+        with zipfile.ZipFile(input_filename) as archive:
+            with archive.open(_get_mscz_score_name(archive)) as fin:
+                yield fin
     else:
-        vbox_element = None
+        with open(input_filename, "rb") as fin:
+            yield fin
 
-    mscx_obj.Score.Order = []
 
-    for i in range(n_parts):
-        if hasattr(parts[i].Instrument, "longName"):
-            output_dictionary["parts"].append(parts[i].Instrument.longName.text)
-        else:
-            output_dictionary["parts"].append(f"Instrument_{i}")
-        
-        mscx_obj.Score.metaTag._setText(parts[i].trackName.text)
-        mscx_obj.Score.Staff = [staffs[i]]
-        mscx_obj.Score.Staff[0].attrib["id"] = "1"
-        mscx_obj.Score.Part = [parts[i]]
-        mscx_obj.Score.Part[0].Staff.attrib["id"] = "1"
+def _set_child(parent_elem, new_elem):
+    # replaces the first child with the tag of `new_elem`, or appends it
+    old_elem = parent_elem.find(new_elem.tag)
+    if old_elem is None:
+        parent_elem.append(new_elem)
+    else:
+        parent_elem.replace(old_elem, new_elem)
+
+    return new_elem
+
+
+def _replace_children(parent_elem, new_elems):
+    # replaces all the children with the tag of `new_elems` by `new_elems`,
+    # placed where the first of them was
+    old_elems = parent_elem.findall(new_elems[0].tag)
+    index = parent_elem.index(old_elems[0]) if len(old_elems) > 0 else len(parent_elem)
+    for old_elem in old_elems:
+        parent_elem.remove(old_elem)
+    for k, new_elem in enumerate(new_elems):
+        parent_elem.insert(index + k, new_elem)
+
+
+def _remove_children(parent_elem, tag):
+    for old_elem in parent_elem.findall(tag):
+        parent_elem.remove(old_elem)
+
+
+class _StaffOwners:
+    # Maps the staves of the score to the parts they belong to, from the
+    # Staff@id listed in every Part (a piano part lists two staves). A staff
+    # whose id is not listed is matched by its position, counting one staff
+    # per listed id and at least one per part.
+    def __init__(self, parts):
+        self.by_id = dict()
+        self.by_position = []
+        self.n_staves = []
+        for part_index, part_elem in enumerate(parts):
+            staff_ids = [staff_elem.get("id") for staff_elem in part_elem.iterchildren("Staff")]
+            for staff_id in staff_ids:
+                self.by_id.setdefault(staff_id, part_index)
+            self.n_staves.append(max(len(staff_ids), 1))
+            self.by_position.extend([part_index] * self.n_staves[-1])
+
+    def owner(self, staff_elem, position):
+        # index of the part of the staff, None for a staff of no part
+        staff_id = staff_elem.get("id")
+        if staff_id in self.by_id:
+            return self.by_id[staff_id]
+        if position < len(self.by_position):
+            return self.by_position[position]
+        return None
+
+
+def _set_part_staves(score_elem, part_elem, staff_elems, first_staff_markers, meta_tag_elem):
+    # makes the score hold the part and its staves only, numbered from 1
+    meta_tag_elem.text = part_elem.findtext("trackName")
+    if first_staff_markers is not None:
+        _insert_first_staff_markers(staff_elems[0], *first_staff_markers)
+    _replace_children(score_elem, staff_elems)
+    _replace_children(score_elem, [part_elem])
+    for k, staff_elem in enumerate(staff_elems):
+        staff_elem.attrib["id"] = str(k + 1)
+    for k, part_staff_elem in enumerate(part_elem.iterchildren("Staff")):
+        part_staff_elem.attrib["id"] = str(k + 1)
+
+
+def iter_parts(input_filename, as_bytes=False, tracer=None, streaming=False):
+    # Yields a `(part_name, part)` pair for every part of the score, one at a
+    # time. `part` is the serialized mscx when `as_bytes` is set, otherwise an
+    # ElementTree that is only valid until the next part is requested (the
+    # parts share the same root and the tempo / repeat elements are moved from
+    # one part to the other). A part keeps all its staves (like the two of a
+    # piano). The parsing and every part are recorded as spans of the
+    # `tracer`, if given.
+    # With `streaming` the score is never loaded as a whole, see
+    # `_iter_parts_streaming`. Both mscx and mscz files are accepted.
+    if streaming:
+        yield from _iter_parts_streaming(input_filename, as_bytes, tracer)
+        return
+
+    with _trace(tracer, "parse score", filename=input_filename):
+        with open_score(input_filename) as fin:
+            mscx_obj = etree.parse(fin, XML_PARSER).getroot()
+        score_elem = mscx_obj.find("Score")
+
+        meta_tag_elem = _set_child(score_elem, etree.Element("metaTag", name="partName"))
+
+        parts = deepcopy(score_elem.findall("Part"))
+        staffs = deepcopy(score_elem.findall("Staff"))
+        staff_owners = _StaffOwners(parts)
+        part_staffs = [[] for _ in parts]
+        for position, staff_elem in enumerate(staffs):
+            part_index = staff_owners.owner(staff_elem, position)
+            if part_index is not None:
+                part_staffs[part_index].append(staff_elem)
+        first_staff_owner = staff_owners.owner(staffs[0], 0) if len(staffs) > 0 else None
+        markers = _get_first_staff_markers(score_elem.find("Staff"))
+
+        _remove_children(score_elem, "Order")
+
+    for i in range(len(parts)):
+        if len(part_staffs[i]) == 0:
+            continue
+        part_name = _get_part_name(parts[i], i)
+
+        with _trace(tracer, f"split {part_name}", part=part_name):
+            _set_part_staves(score_elem, parts[i], part_staffs[i],
+                             None if i == first_staff_owner else markers, meta_tag_elem)
+
+            part = etree.ElementTree(mscx_obj)
+            if as_bytes:
+                part = etree.tostring(part, pretty_print=True)
+
+        yield part_name, part
+
+
+def _iter_parts_streaming(input_filename, as_bytes=False, tracer=None):
+    # Memory-bounded version of `iter_parts` for very large scores. The file
+    # is read incrementally with a pull parser: only the score header (Style,
+    # metaTags, Parts, ...), the markers of the first staff and the staves
+    # of the part being split are kept in memory; every part is produced as
+    # soon as its staves have been parsed and they are released afterwards.
+    # Unlike `iter_parts`, the Score children that follow the staves (like
+    # the excerpts) are not copied into the parts: they are dropped while
+    # they are parsed.
+    parser = etree.XMLPullParser(events=("start", "end"), remove_blank_text=True)
+
+    score_elem = None
+    header = None
+    parts = []
+    parts_position = 0
+    staff_owners = None
+    staff_position = 0
+    first_staff_owner = None
+    markers = None
+    # the staves of the part being collected
+    part_index = None
+    part_staffs = []
+    # the Score child after the staves that is being parsed, and dropped
+    dropped_elem = None
+
+    def make_part(part_index, part_staffs):
+        part_name = _get_part_name(parts[part_index], part_index)
+        with _trace(tracer, f"split {part_name}", part=part_name):
+            # the part is copied: a proxy to an element moved into the part
+            # document would keep that whole document alive
+            part_elem = deepcopy(parts[part_index])
+            mscx_obj = deepcopy(header)
+            part_score_elem = mscx_obj.find("Score")
+            part_score_elem.insert(parts_position, part_elem)
+            part_score_elem.extend(part_staffs)
+            _set_part_staves(part_score_elem, part_elem, part_staffs,
+                             None if part_index == first_staff_owner else markers,
+                             part_score_elem.find("metaTag"))
+
+            part = etree.ElementTree(mscx_obj)
+            if as_bytes:
+                part = etree.tostring(part, pretty_print=True)
+
+        return part_name, part
+
+    with open_score(input_filename) as fin:
+        while True:
+            chunk = fin.read(STREAMING_CHUNK_SIZE)
+            if chunk:
+                parser.feed(chunk)
+            else:
+                parser.close()
+
+            for event, elem in parser.read_events():
+                if event == "start":
+                    if score_elem is None and elem.tag == "Score":
+                        score_elem = elem
+                    elif header is None and elem.tag == "Staff" and elem.getparent() is score_elem:
+                        # the header is complete: keep a copy without the staves,
+                        # prepared the same way as in `iter_parts`
+                        with _trace(tracer, "parse header", filename=input_filename):
+                            header = deepcopy(score_elem.getparent())
+                            header_score_elem = header.find("Score")
+                            for header_child in header_score_elem[score_elem.index(elem):]:
+                                header_score_elem.remove(header_child)
+                            _set_child(header_score_elem, etree.Element("metaTag", name="partName"))
+                            _remove_children(header_score_elem, "Order")
+                            parts = header_score_elem.findall("Part")
+                            parts_position = header_score_elem.index(parts[0])
+                            for part_elem in parts:
+                                header_score_elem.remove(part_elem)
+                            staff_owners = _StaffOwners(parts)
+                    elif (header is not None and dropped_elem is None and elem.tag != "Staff"
+                          and elem.getparent() is score_elem):
+                        dropped_elem = elem
+                    continue
+
+                if dropped_elem is not None:
+                    # an element after the staves (an excerpt, ...), released
+                    # as soon as it has been parsed, its children first
+                    elem.getparent().remove(elem)
+                    if elem is dropped_elem:
+                        dropped_elem = None
+                    continue
+
+                if elem.tag != "Staff" or elem.getparent() is not score_elem:
+                    continue
+
+                # a staff was parsed completely
+                score_elem.remove(elem)
+                owner = staff_owners.owner(elem, staff_position)
+                if staff_position == 0:
+                    # the markers are taken from a copy, the part of the
+                    # first staff keeps it untouched
+                    first_staff_owner = owner
+                    markers = _get_first_staff_markers(deepcopy(elem))
+                staff_position += 1
+                if owner is None:
+                    continue
+
+                if part_index is not None and owner != part_index:
+                    yield make_part(part_index, part_staffs)
+                    part_staffs = []
+                part_index = owner
+                part_staffs.append(elem)
+                if len(part_staffs) == staff_owners.n_staves[part_index]:
+                    yield make_part(part_index, part_staffs)
+                    part_index, part_staffs = None, []
+
+            if not chunk:
+                break
+
+    if part_index is not None:
+        yield make_part(part_index, part_staffs)
+
+
+def _trim_staff(staff_elem, first_measure, last_measure):
+    measures = list(staff_elem.iterchildren("Measure"))
+    if not 1 <= first_measure <= last_measure <= len(measures):
+        raise ValueError(f"the measures {first_measure}-{last_measure} are not in the "
+                         f"{len(measures)} measures of the score")
+
+    # the state elements of the measures before the range, the last one of
+    # every tag by position
+    time_map = StaffTimeMap(staff_elem)
+    state = dict()
+    for measure_elem in measures[:first_measure - 1]:
+        measure_start = time_map.measure_starts[time_map.measure_indices[measure_elem]]
+        for voice_elem in measure_elem.iterchildren("voice"):
+            for state_elem in voice_elem.iterchildren(*STATE_TAGS):
+                position = measure_start + time_map.voice_onsets[state_elem]
+                if state_elem.tag not in state or position >= state[state_elem.tag][0]:
+                    state[state_elem.tag] = (position, state_elem)
+
+    # they are copied to the start of the range, unless its first measure
+    # sets them itself
+    first_voice_elem = measures[first_measure - 1].find("voice")
+    if first_voice_elem is not None:
+        own_tags = {state_elem.tag for state_elem in first_voice_elem.iterchildren(*STATE_TAGS)
+                    if time_map.voice_onsets[state_elem] == 0}
+        for tag in reversed(STATE_TAGS):
+            if tag in state and tag not in own_tags:
+                first_voice_elem.insert(0, deepcopy(state[tag][1]))
+
+    for measure_elem in measures[:first_measure - 1] + measures[last_measure:]:
+        staff_elem.remove(measure_elem)
+
+
+def trim_measures(mscx_root, first_measure, last_measure):
+    # Keeps only the measures `first_measure`..`last_measure` (counted from 1
+    # in the order of the score, both included) of every staff of a part
+    # tree, in place; a range that is not inside the score raises ValueError.
+    # The clef, key / time signature, tempo and dynamic in effect at the
+    # start of the range are copied into its first measure, so the excerpt
+    # plays as it does inside the whole score. The frames (VBox, ...) are
+    # kept; the repeats, jumps and spanners of the range are left as they are.
+    for staff_elem in mscx_root.iterfind("Score/Staff"):
+        _trim_staff(staff_elem, first_measure, last_measure)
+
+
+def get_part_names(input_filename):
+    # the names of the parts, as given by `iter_parts`, read from the score
+    # header only: the parsing stops at the first staff
+    parser = etree.XMLPullParser(events=("start", "end"), remove_blank_text=True)
+    score_elem = None
+    part_names = []
+
+    with open_score(input_filename) as fin:
+        while True:
+            chunk = fin.read(STREAMING_CHUNK_SIZE)
+            if not chunk:
+                return part_names
+            parser.feed(chunk)
+
+            for event, elem in parser.read_events():
+                if event == "start":
+                    if score_elem is None and elem.tag == "Score":
+                        score_elem = elem
+                    elif elem.tag == "Staff" and elem.getparent() is score_elem:
+                        return part_names
+                elif elem.tag == "Part" and elem.getparent() is score_elem:
+                    part_names.append(_get_part_name(elem, len(part_names)))
+
+
+def write_parts(input_filename, get_output_filename, tracer=None, streaming=False):
+    # writes every part straight to `get_output_filename(part_name)` and
+    # returns the list of `(part_name, output_filename)` pairs
+    written_parts = []
+    for part_name, part_bytes in iter_parts(input_filename, as_bytes=True, tracer=tracer,
+                                            streaming=streaming):
+        output_filename = get_output_filename(part_name)
+        with open(output_filename, "wb") as fout:
+            fout.write(part_bytes)
+        written_parts.append((part_name, output_filename))
+
+    return written_parts
+
+
+def generate_parts(input_filename, tracer=None):
+    # kept for compatibility with the `--score-parts` like output: all the
+    # parts are held in memory, encoded in base64
+    output_dictionary = {
+        "parts": [],
+        "partsBin": []
+    }
 
-        if i > 0:
-            if vbox_element is not None:
-                mscx_obj.Score.Staff[0].insert(0, vbox_element)
-
-            staff_children = mscx_obj.Score.Staff[0].getchildren()
-            for j, measure_index in enumerate(tempo_elements_dict["measure_indices"]):
-                # staff_children[measure_index].voice.insert(tempo_elements_dict["location_inside_measure"][j],
-                                                        #    tempo_elements_dict["tempo_elements"][j])
-
-                note_element = _get_note_for_tempo(
-                    staff_children[measure_index], tempo_elements_dict["duration_passed"][j])
-                note_element.addprevious(tempo_elements_dict["tempo_elements"][j])
-
-            for j, measure_index in enumerate(repeat_elements_dict["measure_indices"]):
-                staff_children[measure_index].insert(repeat_elements_dict["location_inside_measure"][j],
-                                                     repeat_elements_dict["repeat_elements"][j])
-
-        mscx_etree = etree.ElementTree(mscx_obj)
-        output_dictionary["partsBin"].append(
-            base64.b64encode(etree.tostring(mscx_etree, pretty_print=True))
-        )
+    for part_name, part_bytes in iter_parts(input_filename, as_bytes=True, tracer=tracer):
+        output_dictionary["parts"].append(part_name)
+        output_dictionary["partsBin"].append(base64.b64encode(part_bytes))
 
     return output_dictionary
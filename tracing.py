@@ -0,0 +1,127 @@
+# Lightweight tracing of the conversion pipeline.
+# A `Tracer` records a span for every stage (split, render, mix, ...) with
+# its start / end time, the thread it ran on and free-form arguments; the
+# spans of child processes also hold the argv, the exit code, the CPU time
+# and the peak RSS of the child. The spans can be saved as JSON lines or in
+# the Chrome trace-event format (chrome://tracing, Perfetto, speedscope).
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+
+class Span:
+    def __init__(self, name, category, start, args):
+        self.name = name
+        self.category = category
+        self.start = start
+        self.end = None
+        self.thread_id = threading.get_ident()
+        self.thread_name = threading.current_thread().name
+        self.args = args
+
+    @property
+    def duration(self):
+        return None if self.end is None else self.end - self.start
+
+    def record_process(self, argv, returncode, rusage = None):
+        # `rusage` is the resource usage of the child, as returned by os.wait4
+        self.args["argv"] = list(argv)
+        self.args["exit_code"] = returncode
+        if rusage is not None:
+            self.args["child_cpu_user"] = rusage.ru_utime
+            self.args["child_cpu_system"] = rusage.ru_stime
+            # kilobytes on Linux, bytes on macOS
+            self.args["child_max_rss"] = rusage.ru_maxrss
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "cat": self.category,
+            "start": self.start,
+            "end": self.end,
+            "duration": self.duration,
+            "thread": self.thread_name,
+            "args": self.args
+        }
+
+
+class Tracer:
+    def __init__(self, verbose = False):
+        # times are seconds since the tracer was created; with `verbose` the
+        # log messages are printed with millisecond resolution
+        self.verbose = verbose
+        self.spans = []
+        self.events = []
+        self._origin = time.perf_counter()
+        self._origin_wall = time.time()
+        self._lock = threading.Lock()
+
+    def now(self):
+        return time.perf_counter() - self._origin
+
+    @contextmanager
+    def span(self, name, category = "stage", **args):
+        span = Span(name, category, self.now(), args)
+        try:
+            yield span
+        except BaseException as error:
+            span.args["error"] = repr(error)
+            raise
+        finally:
+            span.end = self.now()
+            with self._lock:
+                self.spans.append(span)
+
+    def log(self, message):
+        timestamp = self.now()
+        with self._lock:
+            self.events.append((timestamp, threading.current_thread().name, message))
+
+        if self.verbose:
+            wall_time = datetime.fromtimestamp(self._origin_wall + timestamp)
+            print(f"[{wall_time.strftime('%H:%M:%S.%f')[:-3]}] {message}")
+
+    def write_json_lines(self, output_filename):
+        with open(output_filename, "w") as fout:
+            for span in sorted(self.spans, key = lambda s: s.start):
+                fout.write(json.dumps(span.to_dict()) + "\n")
+
+    def write_chrome_trace(self, output_filename):
+        pid = os.getpid()
+        trace_events = []
+        thread_names = dict()
+
+        for span in self.spans:
+            thread_names[span.thread_id] = span.thread_name
+            trace_events.append({
+                "name": span.name,
+                "cat": span.category,
+                "ph": "X",
+                "ts": span.start * 1e6,
+                "dur": (span.end - span.start) * 1e6,
+                "pid": pid,
+                "tid": span.thread_id,
+                "args": span.args
+            })
+
+        for timestamp, _, message in self.events:
+            trace_events.append({"name": message, "ph": "i", "s": "g", "ts": timestamp * 1e6, "pid": pid, "tid": 0})
+
+        for thread_id, thread_name in thread_names.items():
+            trace_events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": thread_id,
+                                 "args": {"name": thread_name}})
+
+        with open(output_filename, "w") as fout:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, fout)
+
+    def write(self, output_filename):
+        # the format is chosen from the extension: `.jsonl` for JSON lines,
+        # anything else for the Chrome trace-event format
+        if output_filename.endswith(".jsonl"):
+            self.write_json_lines(output_filename)
+        else:
+            self.write_chrome_trace(output_filename)